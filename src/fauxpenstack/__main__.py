@@ -12,26 +12,59 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import asyncio
-import ctypes
+import json
 import logging
 import os
+import signal
 import socket
 import time
 from pathlib import Path
-from typing import Optional
-import toml
+from typing import TYPE_CHECKING, List, Optional
 
 import click
 from aiohttp import web
 
-from . import brisk, glue, neutrino, peek, plaster, pulsar
-from .middlewares import acl_middleware, idler, no_rel
+from . import (
+    brisk,
+    glue,
+    metrics,
+    neutrino,
+    peek,
+    placement,
+    plaster,
+    profiler,
+    pulsar,
+)
+from .config import Config
+from .middlewares import (
+    acl_middleware,
+    idler,
+    limit_middleware,
+    limiter,
+    no_rel,
+    snapshot_config,
+)
+
+if TYPE_CHECKING:
+    from .supervisor import Proxy
+
+
+# how long workers get to finish what they are doing on shutdown
+STOP_TIMEOUT = 10
+
+
+def systemd_socket() -> Optional[socket.socket]:
+    """The socket systemd hands us, if any. See sd_listen_fds(3)."""
+    if os.environ.get("LISTEN_PID") != str(os.getpid()):
+        return None
+    if not (fd_count := int(os.environ.get("LISTEN_FDS", 0))):
+        return None
+    assert fd_count == 1, "systemd passed us multiple socket?!"
+    return socket.socket(fileno=3)
 
 
 async def on_startup(app: web.Application, timeout: int):
     async def _wait():
-        import signal
-
         while time.time() - timeout < app["last_request"][0]:
             await asyncio.sleep(timeout)
         logging.error("Service idle for %ds. Shutting down.", timeout)
@@ -40,43 +73,244 @@ async def on_startup(app: web.Application, timeout: int):
     asyncio.create_task(_wait())
 
 
+def apply_config(app: web.Application, config: Config) -> None:
+    app["config"][0] = config
+    plaster.pool.configure(config.get("volume_pool", {}))
+    limiter.configure(config.get("limits", {}))
+    neutrino.ipam.configure(config.get("net_subnets", {}))
+    placement.cpus.configure(config.get("placement", {}))
+    profiler.slow_requests.configure(config.get("tracing", {}))
+
+
+async def on_reload(app: web.Application, conf: Path):
+    def _reload():
+        try:
+            config = Config.load(conf)
+        except (OSError, ValueError):
+            logging.exception("Could not reload config, keeping the current one.")
+            return
+        apply_config(app, config)
+        logging.info("Reloaded %s", conf)
+
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, _reload)
+
+
+def make_app(
+    config: Config,
+    conf: Path,
+    last_request,
+    record: Optional[Path] = None,
+    proxy: Optional["Proxy"] = None,
+    supervisor: bool = False,
+) -> web.Application:
+    """The whole service, or a worker handing stateful requests to proxy.
+
+    A supervisor only gets requests from workers, which already counted
+    and throttled them.
+    """
+    middlewares = [
+        metrics.middleware,
+        profiler.slow_requests.middleware,
+        idler,
+        snapshot_config,
+        no_rel,
+        acl_middleware(),
+        limit_middleware,
+    ]
+    if supervisor:
+        middlewares.remove(metrics.middleware)
+        middlewares.remove(limit_middleware)
+    if record:
+        from .recorder import Recorder
+
+        recorder = Recorder(record)
+        middlewares.insert(0, recorder.middleware)
+    app = web.Application(middlewares=middlewares)
+    if record:
+        app.on_cleanup.append(recorder.cleanup)
+    app["root_app"] = app
+    app["config"] = [config]  # swapped on reload
+    app["last_request"] = last_request
+    apply_config(app, config)
+    app.on_startup.append(lambda a: on_reload(a, conf))
+    app.on_startup.append(profiler.on_startup)
+    if proxy:
+        from .supervisor import watch_supervisor
+
+        app.on_startup.append(proxy.start)
+        app.on_startup.append(watch_supervisor)
+        app.on_cleanup.append(proxy.close)
+        # revocations have a single writer, workers pick them up from disk
+        for path in ("/identity/v3/auth/tokens", "/v3/auth/tokens"):
+            app.router.add_delete(path, proxy.handler)
+    app.add_subapp("/identity", glue.app)
+    app.add_routes(glue.routes)
+    app.router.add_get("/metrics", proxy.metrics if proxy else metrics.handler)
+    app.add_routes(profiler.routes)
+    app.add_subapp("/objects", brisk.app)
+    app.add_subapp("/images", peek.app)
+    for prefix, sub in (
+        ("/compute", pulsar.app),
+        ("/network", neutrino.app),
+        ("/storage/v3", plaster.app),
+    ):
+        app.add_subapp(prefix, proxy.app(sub) if proxy else sub)
+    return app
+
+
+async def stop_workers(app: web.Application, workers: List[int]) -> None:
+    """Ask workers to stop, and kill those still around after STOP_TIMEOUT."""
+    loop = asyncio.get_running_loop()
+    for pid in workers:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    waits = {pid: loop.run_in_executor(None, os.waitpid, pid, 0) for pid in workers}
+    _, stuck = await asyncio.wait(waits.values(), timeout=STOP_TIMEOUT)
+    for pid, waiting in waits.items():
+        if waiting in stuck:
+            logging.warning("worker %d did not stop, killing it", pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+    # reaped, or already gone
+    await asyncio.gather(*waits.values(), return_exceptions=True)
+
+
 @click.option("--port", type=int, default=8855)
 @click.option("--conf", type=Path, default="conf.toml")
 @click.option("--dir", type=Path, help="work dir")
 @click.option("--idle", type=int, help="stop after idle time")
+@click.option("--record", type=Path, help="append served requests to a jsonl file")
+@click.option("--workers", type=int, default=1, help="processes serving requests")
 @click.option("-v", "--verbose", help="verbose", count=True)
-@click.command()
-def main(conf: Path, port: int, dir: Path, idle: Optional[int], verbose: int) -> None:
+@click.group(invoke_without_command=True)
+@click.pass_context
+def main(
+    ctx: click.Context,
+    conf: Path,
+    port: int,
+    dir: Path,
+    idle: Optional[int],
+    record: Optional[Path],
+    workers: int,
+    verbose: int,
+) -> None:
     logging.basicConfig(level=20 - verbose * 10)
 
     if dir:
         os.chdir(dir)
+    if ctx.invoked_subcommand:
+        return
 
     try:
-        app_config = toml.load(conf)
-    except OSError:
+        config = Config.load(conf)
+    except (OSError, ValueError):
         logging.exception("Could not read config data store.")
+        raise SystemExit(1)
 
-    app = web.Application(middlewares=[idler, no_rel, acl_middleware(app_config)])
-    app["root_app"] = app
-    app["app_config"] = app_config
-    app["last_request"] = [time.time()]  # make mutable ref
+    # check if systemd is handing us a port and use that
+    sock = systemd_socket()
+
+    if workers <= 1:
+        app = make_app(config, conf, [time.time()], record)  # make mutable ref
+        if idle:
+            app.on_startup.append(lambda a: on_startup(a, idle))
+        if sock:
+            web.run_app(app, sock=sock)
+        else:
+            web.run_app(app, port=port)
+        return
+
+    # Workers share the public socket, or each bind it with SO_REUSEPORT,
+    # and forward what touches VMs, volumes and addresses to this process.
+    import multiprocessing
+
+    from .supervisor import SOCKET, Proxy
+
+    SOCKET.unlink(missing_ok=True)
+    supervisor_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    supervisor_sock.bind(str(SOCKET))
+    supervisor_sock.listen(128)
+    last_request = multiprocessing.RawArray("d", [time.time()])
+    pids = []
+    for n in range(workers):
+        if pid := os.fork():
+            pids.append(pid)
+            continue
+        supervisor_sock.close()
+        worker_record = record and record.with_suffix(f".{n}{record.suffix}")
+        app = make_app(config, conf, last_request, worker_record, Proxy(SOCKET))
+        if sock:
+            web.run_app(app, sock=sock, print=None)
+        else:
+            web.run_app(app, port=port, reuse_port=True, print=None)
+        os._exit(0)
+
+    app = make_app(config, conf, last_request, supervisor=True)
+    app.on_cleanup.append(lambda a: stop_workers(a, pids))
     if idle:
         app.on_startup.append(lambda a: on_startup(a, idle))
-    app.add_subapp("/identity", glue.app)
-    app.add_routes(glue.routes)
-    app.add_subapp("/objects", brisk.app)
-    app.add_subapp("/images", peek.app)
-    app.add_subapp("/compute", pulsar.app)
-    app.add_subapp("/network", neutrino.app)
-    app.add_subapp("/storage/v3", plaster.app)
+    web.run_app(app, sock=supervisor_sock)
 
-    # check if systemd is handing us a port and use that
-    if fd_count := ctypes.cdll.LoadLibrary("libsystemd.so.0").sd_listen_fds(0):
-        assert fd_count == 1, "systemd passed us multiple socket?!"
-        web.run_app(app, sock=socket.fromfd(3, socket.AF_INET6, socket.SOCK_STREAM))
-    else:
-        web.run_app(app, port=port)
+
+@click.argument("recording", type=Path)
+@click.option("--target", default="http://localhost:8855", help="server to hit")
+@click.option(
+    "--speed", type=float, default=1.0, help="pace multiplier, 0 for no pauses"
+)
+@click.option("--concurrency", type=int, default=16)
+@click.option("--token", envvar="OS_TOKEN", help="X-Auth-Token to send")
+@main.command()
+def replay(
+    recording: Path, target: str, speed: float, concurrency: int, token: Optional[str]
+) -> None:
+    """Replay a --record capture, then report throughput and latencies."""
+    from .recorder import replay as _replay
+
+    results = asyncio.run(_replay(recording, target, speed, concurrency, token))
+    click.echo(json.dumps(results, indent=2))
+
+
+@main.group()
+def bench() -> None:
+    """Measure how fast things go, reported as json."""
+
+
+@click.option("--runs", type=int, default=5)
+@click.option("--path", default="/identity/", help="what to request first")
+@bench.command()
+@click.pass_context
+def startup(ctx: click.Context, runs: int, path: str) -> None:
+    """Time from exec to a first served request, as with socket activation."""
+    from . import bench as _bench
+
+    conf = ctx.find_root().params["conf"]
+    click.echo(json.dumps(_bench.startup(conf, runs, path), indent=2))
+
+
+@click.option("--rounds", type=int, default=5)
+@click.option("--only", multiple=True, help="benchmarks to run, defaults to all")
+@bench.command("run")
+def run_bench(rounds: int, only: List[str]) -> None:
+    """Time the hot paths of every service, in a scratch directory."""
+    from . import bench as _bench
+
+    if unknown := set(only) - set(_bench.BENCHMARKS):
+        raise click.BadParameter(f"no such benchmarks: {', '.join(unknown)}")
+    click.echo(json.dumps(_bench.run(make_app, list(only), rounds), indent=2))
+
+
+@click.argument("new", type=click.File())
+@click.argument("base", type=click.File())
+@bench.command("compare")
+def compare_bench(base, new) -> None:
+    """Compare median timings of two bench outputs, base first."""
+    from . import bench as _bench
+
+    click.echo(json.dumps(_bench.compare(json.load(base), json.load(new)), indent=2))
 
 
 if __name__ == "__main__":
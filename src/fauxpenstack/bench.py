@@ -0,0 +1,426 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmarks, reporting json so runs can be compared.
+
+`run` drives the hot paths of every service in process, through the real
+middlewares, from a scratch directory and with qemu stubbed out.
+"""
+import asyncio
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from .config import Config
+
+# samples for cheap operations, per round
+REPEAT = 50
+OBJECT_SIZES = (4 << 10, 1 << 20, 64 << 20)
+OBJECT_COUNTS = (10_000, 100_000)
+IMAGE_COUNTS = (100, 1000)
+ACL_SIZES = (10, 100, 1000)
+SERVERS = 10  # per round
+
+USER = "bench"
+PASSWORD = "bench"
+STUB_QEMU = "#!/bin/sh\nexec sleep 86400\n"
+
+
+def _summary(samples: List[float], ops: int = 1, size: int = 0) -> dict:
+    """Timings of samples, each of ops operations moving size bytes."""
+    samples = sorted(samples)
+    median = statistics.median(samples)
+    summary = {
+        "runs": len(samples),
+        "min_ms": samples[0] * 1000,
+        "median_ms": median * 1000,
+        "max_ms": samples[-1] * 1000,
+    }
+    if ops > 1:
+        summary["ops_per_s"] = ops / median
+    if size:
+        summary["mb_per_s"] = size / median / 2**20
+    return summary
+
+
+def startup(conf: Path, runs: int = 5, path: str = "/identity/") -> dict:
+    """Time from exec to a first request served, like after socket activation.
+
+    The request is sent before the service starts, it waits in the listen
+    backlog the same way it does when systemd starts us on demand.
+    """
+    samples = []
+    for _ in range(runs):
+        with socket.create_server(("127.0.0.1", 0)) as listener:
+
+            def _activate():
+                os.dup2(listener.fileno(), 3)
+                os.environ["LISTEN_FDS"] = "1"
+                os.environ["LISTEN_PID"] = str(os.getpid())
+
+            client = socket.create_connection(listener.getsockname())
+            client.sendall(
+                f"GET {path} HTTP/1.1\r\nHost: localhost\r\n"
+                "Connection: close\r\n\r\n".encode("ascii")
+            )
+            start = time.monotonic()
+            service = subprocess.Popen(
+                [sys.executable, "-m", "fauxpenstack", "--conf", str(conf.absolute())],
+                preexec_fn=_activate,
+                pass_fds=(3,),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        try:
+            with client:
+                response = client.recv(1 << 16)
+                samples.append(time.monotonic() - start)
+            if not response.startswith(b"HTTP/1.1 200"):
+                raise RuntimeError(f"unexpected response: {response[:64]!r}")
+        finally:
+            service.send_signal(signal.SIGINT)
+            service.wait()
+    return {"startup": _summary(samples)}
+
+
+def _config(**overrides) -> Config:
+    data = {
+        "secret_key": "bench",
+        "token_format": "compact",
+        "users": {USER: {"password": PASSWORD}},
+        "roles": {"users": [USER]},
+        "flavors": {"bench": {"vcpus": 1, "ram": 256, "disk": 1024}},
+        # boot disks made on demand, so every create does the same work
+        "volume_pool": {"depth": 0},
+        "acls": {
+            "/identity/v3/auth/tokens": {"ANONYMOUS": ["get", "post"]},
+            "/*": {"users": ["get", "head", "put", "post", "delete"]},
+        },
+    }
+    data.update(overrides)
+    return Config(data)
+
+
+class Bench:
+    """A client logged in to the service under test."""
+
+    def __init__(self, client, rounds: int):
+        self.client = client
+        self.rounds = rounds
+        self.headers: Dict[str, str] = {}
+        self.last_headers = None
+
+    @property
+    def app(self):
+        return self.client.server.app
+
+    async def request(self, method: str, path: str, **kwargs) -> bytes:
+        headers = {**self.headers, **kwargs.pop("headers", {})}
+        async with self.client.request(method, path, headers=headers, **kwargs) as r:
+            body = await r.read()
+            if r.status >= 300:
+                raise RuntimeError(f"{method} {path}: {r.status} {body[:64]!r}")
+            self.last_headers = r.headers
+            return body
+
+    async def timed(self, op: Callable[[], Awaitable], runs: int = 0) -> List[float]:
+        samples = []
+        for _ in range(runs or self.rounds):
+            start = time.perf_counter()
+            await op()
+            samples.append(time.perf_counter() - start)
+        return samples
+
+    async def login(self) -> str:
+        await self.request("POST", "/identity/v3/auth/tokens", json=_credentials())
+        return self.last_headers["X-Subject-Token"]
+
+
+def _credentials() -> dict:
+    return {
+        "auth": {
+            "identity": {
+                "methods": ["password"],
+                "password": {"user": {"name": USER, "password": PASSWORD}},
+            }
+        }
+    }
+
+
+def _size(size: int) -> str:
+    for unit in ("", "k", "m"):
+        if size < 1024:
+            break
+        size //= 1024
+    return f"{size}{unit}"
+
+
+async def _brisk(bench: Bench) -> dict:
+    results = {}
+    await bench.request("PUT", "/objects/bench")
+    for size in OBJECT_SIZES:
+        data = os.urandom(size)
+        path = f"/objects/bench/object-{_size(size)}"
+
+        async def _upload():
+            await bench.request("PUT", path, data=data)
+
+        async def _download():
+            await bench.request("GET", path)
+
+        results[f"upload_{_size(size)}"] = _summary(
+            await bench.timed(_upload), size=size
+        )
+        results[f"download_{_size(size)}"] = _summary(
+            await bench.timed(_download), size=size
+        )
+
+    for count in OBJECT_COUNTS:
+        bucket = Path("buckets") / f"list-{count}"
+        bucket.mkdir()
+        for i in range(count):
+            (bucket / f"object-{i:06d}").touch()
+
+        async def _list():
+            await bench.request("GET", f"/objects/{bucket.name}")
+
+        results[f"list_{count}"] = _summary(await bench.timed(_list), ops=count)
+    return results
+
+
+async def _peek(bench: Bench) -> dict:
+    results = {}
+    images = Path("images")
+    made = 0
+    for count in IMAGE_COUNTS:
+        for i in range(made, count):
+            (images / f"{uuid.uuid4()}:bench-{i}.x86_64.qcow2").touch()
+        made = count
+
+        async def _list():
+            await bench.request("GET", "/images/v2/images")
+
+        results[f"list_{count}"] = _summary(await bench.timed(_list), ops=count)
+    return results
+
+
+async def _glue(bench: Bench) -> dict:
+    results = {}
+    configs = bench.app["config"]
+    current = configs[0]
+    try:
+        for token_format in ("compact", "full"):
+            configs[0] = _config(token_format=token_format)
+            token = await bench.login()
+
+            async def _issue():
+                await bench.request(
+                    "POST", "/identity/v3/auth/tokens", json=_credentials()
+                )
+
+            async def _verify():
+                await bench.request(
+                    "GET",
+                    "/identity/v3/auth/tokens",
+                    headers={"X-Subject-Token": token},
+                )
+
+            runs = bench.rounds * REPEAT
+            results[f"issue_{token_format}"] = _summary(await bench.timed(_issue, runs))
+            results[f"verify_{token_format}"] = _summary(
+                await bench.timed(_verify, runs)
+            )
+    finally:
+        configs[0] = current
+    return results
+
+
+async def _acl(bench: Bench) -> dict:
+    """The acl middleware alone, as the network would drown it out."""
+    from aiohttp import web
+    from aiohttp.test_utils import make_mocked_request
+
+    from . import glue
+    from .middlewares import acl_middleware
+
+    results = {}
+    middleware = acl_middleware()
+    response = web.Response()
+
+    async def _handler(request):
+        return response
+
+    calls = REPEAT * 20
+    for size in ACL_SIZES:
+        acls = {f"/objects/bucket-{i}*": {"users": ["get", "put"]} for i in range(size)}
+        config = _config(acls=acls)
+        token = glue.encode_compact_token(
+            config["secret_key"], USER, datetime.now(timezone.utc).replace(year=9999)
+        )
+        compile_samples = []
+        for _ in range(bench.rounds):
+            start = time.perf_counter()
+            config = _config(acls=acls)
+            compile_samples.append(time.perf_counter() - start)
+        results[f"load_{size}"] = _summary(compile_samples)
+
+        def _request(path: str):
+            request = make_mocked_request("GET", path, headers={"X-Auth-Token": token})
+            request["app_config"] = config
+            return request
+
+        # the last rule, always the same path
+        hit = [_request(f"/objects/bucket-{size - 1}/object")] * calls
+        # paths not seen yet, and paths nothing allows
+        miss = [_request(f"/objects/bucket-{size - 1}/{i}") for i in range(calls)]
+        deny = [_request(f"/objects/nope/{i}") for i in range(calls)]
+        for name, requests in (("hit", hit), ("miss", miss), ("deny", deny)):
+            samples = []
+            for _ in range(bench.rounds):
+                config.acl.cache_clear()
+                start = time.perf_counter()
+                for request in requests:
+                    await middleware(request, _handler)
+                samples.append(time.perf_counter() - start)
+            results[f"{name}_{size}"] = _summary(samples, ops=calls)
+    return results
+
+
+async def _pulsar(bench: Bench) -> dict:
+    image_id = str(uuid.uuid4())
+    (Path("images") / f"{image_id}:bench.x86_64.qcow2").touch()
+    server = {"server": {"name": "bench", "flavorRef": "bench", "imageRef": image_id}}
+    servers = []
+
+    async def _create():
+        body = await bench.request("POST", "/compute/servers", json=server)
+        servers.append(json.loads(body)["server"]["id"])
+
+    async def _list():
+        await bench.request("GET", "/compute/servers/detail")
+
+    async def _delete():
+        await bench.request("DELETE", f"/compute/servers/{servers.pop()}")
+
+    count = bench.rounds * SERVERS
+    results = {"create": _summary(await bench.timed(_create, count))}
+    results[f"list_{count}"] = _summary(await bench.timed(_list), ops=count)
+    results["delete"] = _summary(await bench.timed(_delete, count))
+    return results
+
+
+BENCHMARKS: Dict[str, Callable[[Bench], Awaitable[dict]]] = {
+    "acl": _acl,
+    "brisk": _brisk,
+    "glue": _glue,
+    "peek": _peek,
+    "pulsar": _pulsar,
+}
+
+
+async def _run(make_app: Callable, names: List[str], rounds: int) -> dict:
+    from aiohttp.test_utils import TestClient, TestServer
+
+    app = make_app(_config(), Path("conf.toml"), [time.time()])
+    results = {}
+    server = TestServer(app)
+    await server.start_server(access_log=None)
+    async with TestClient(server) as client:
+        bench = Bench(client, rounds)
+        bench.headers["X-Auth-Token"] = await bench.login()
+        for name in names:
+            results[name] = await BENCHMARKS[name](bench)
+    return results
+
+
+def run(make_app: Callable, names: Optional[List[str]] = None, rounds: int = 5) -> dict:
+    """Run benchmarks against what make_app builds.
+
+    Everything happens in a scratch directory, with a qemu which only sleeps.
+    """
+    import aiohttp
+
+    names = names or sorted(BENCHMARKS)
+    cwd = os.getcwd()
+    path = os.environ["PATH"]
+    scratch = tempfile.mkdtemp(prefix="fauxpenstack-bench-")
+    try:
+        os.chdir(scratch)
+        for directory in (
+            "bin",
+            "buckets",
+            "configdrives",
+            "consoles",
+            "images",
+            "keypairs",
+            "volumes",
+        ):
+            os.mkdir(directory)
+        qemu = Path("bin/qemu-system-x86_64")
+        qemu.write_text(STUB_QEMU)
+        qemu.chmod(0o755)
+        os.environ["PATH"] = f"{Path('bin').absolute()}:{path}"
+        started = datetime.now(timezone.utc).isoformat("T", "seconds")
+        results = asyncio.run(_run(make_app, names, rounds))
+    finally:
+        os.environ["PATH"] = path
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+    return {
+        "meta": {
+            "started": started,
+            "rounds": rounds,
+            "python": platform.python_version(),
+            "aiohttp": aiohttp.__version__,
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+
+
+def _medians(results: dict, prefix: str = "") -> Dict[str, float]:
+    medians = {}
+    for name, value in results.items():
+        if isinstance(value, dict):
+            if "median_ms" in value:
+                medians[prefix + name] = value["median_ms"]
+            else:
+                medians.update(_medians(value, f"{prefix}{name}."))
+    return medians
+
+
+def compare(base: dict, new: dict) -> dict:
+    """How median timings of new moved against base, by benchmark."""
+    base_medians = _medians(base.get("results", base))
+    comparison = {}
+    for name, median in _medians(new.get("results", new)).items():
+        if (before := base_medians.get(name)) is None:
+            continue
+        comparison[name] = {
+            "base_ms": before,
+            "new_ms": median,
+            "change": median / before - 1 if before else None,
+        }
+    return comparison
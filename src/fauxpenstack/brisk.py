@@ -15,13 +15,16 @@
 
 import hashlib
 import logging
-import os
 import time
 from pathlib import Path
+from typing import AsyncIterator, Optional
 
 import aiofiles.os
 from aiohttp import web
 
+from . import fs, metrics
+from .util import json_response, json_stream
+
 routes = web.RouteTableDef()
 app = web.Application()
 app["ep_type"] = "object-store"
@@ -32,6 +35,9 @@ CHUNK_SIZE = 10240
 
 hash_cache = {}
 
+_bytes_in = metrics.TRANSFER.labels("brisk", "in")
+_bytes_out = metrics.TRANSFER.labels("brisk", "out")
+
 
 async def stat(path: Path) -> dict:
     stat = await aiofiles.os.stat(path)
@@ -63,9 +69,10 @@ async def list_buckets(request: web.Request) -> web.Response:
     end_marker = request.query.get("end_marker")
     prefix = request.query.get("prefix")
     listing = []
-    for bucket in await aiofiles.os.listdir(BUCKETS):
-        if not os.path.isdir(BUCKETS / bucket):
+    async for entry in fs.scandir(BUCKETS):
+        if not entry.is_dir():
             continue
+        bucket = entry.name
         if (end_marker and bucket > end_marker) or (limit and len(listing) > limit):
             break
         if marker and bucket <= marker:
@@ -73,40 +80,52 @@ async def list_buckets(request: web.Request) -> web.Response:
         if prefix and not bucket.startswith(prefix):
             continue
         listing.append({"count": 0, "bytes": 0, "name": bucket})
-    return web.json_response(listing)
+    return json_response(listing)
+
+
+async def _objects(
+    path: Path,
+    limit: int,
+    marker: Optional[str],
+    end_marker: Optional[str],
+    prefix: Optional[str],
+) -> AsyncIterator[dict]:
+    trim = len(str(path)) + 1
+    count = 0
+    async for parent, files in fs.walk(path):
+        if end_marker and parent > end_marker:
+            break
+        if marker and parent < marker:
+            continue
+        for f in files:
+            if limit and count >= limit:
+                return
+            obj_name = f"{parent[trim:]}/{f.name}"
+            if prefix and not obj_name.startswith(prefix):
+                continue
+
+            count += 1
+            yield {
+                "hash": "FIXME",
+                "bytes": "FIXME",
+                "name": obj_name,
+                "content_type": "application/octet-stream",
+            }
 
 
 @routes.get("/{bucket}")
-async def list_bucket(request: web.Request) -> web.Response:
-    limit = int(request.query.get("limit", 0))
-    marker = request.query.get("marker")
-    end_marker = request.query.get("end_marker")
-    prefix = request.query.get("prefix")
-    try:
-        listing = []
-        path = BUCKETS / request.match_info["bucket"]
-        trim = len(str(path)) + 1
-        for parent, _dirs, files in os.walk(path):  # XXX not async
-            if (end_marker and parent > end_marker) or (limit and len(listing) > limit):
-                break
-            if marker and parent < marker:
-                continue
-            for f in files:
-                obj_name = f"{parent[trim:]}/{f}"
-                if prefix and not obj_name.startswith(prefix):
-                    continue
-
-                listing.append(
-                    {
-                        "hash": "FIXME",
-                        "bytes": "FIXME",
-                        "name": obj_name,
-                        "content_type": "application/octet-stream",
-                    }
-                )
-    except FileNotFoundError:
+async def list_bucket(request: web.Request) -> web.StreamResponse:
+    path = BUCKETS / request.match_info["bucket"]
+    if not await aiofiles.os.path.isdir(path):
         return web.Response(status=404)
-    return web.json_response(listing)
+    objects = _objects(
+        path,
+        int(request.query.get("limit", 0)),
+        request.query.get("marker"),
+        request.query.get("end_marker"),
+        request.query.get("prefix"),
+    )
+    return await json_stream(request, objects)
 
 
 @routes.head("/{bucket}/{path:.+}")
@@ -143,6 +162,7 @@ async def upload(request: web.Request):
         body = request.content
         async for chunk in body.iter_any():
             await f.write(chunk)
+            _bytes_in.inc(len(chunk))
     return web.Response()
 
 
@@ -163,6 +183,7 @@ async def download(request: web.Request) -> web.Response:
         await response.prepare(request)
         while chunk := await f.read(CHUNK_SIZE):
             await response.write(chunk)
+            _bytes_out.inc(len(chunk))
         return response
 
 
@@ -172,18 +193,9 @@ async def delete(request: web.Request) -> web.Response:
     path = bucket / request.match_info["path"]
     hash_cache.pop(path, None)
     try:
-        await aiofiles.os.remove(path)
+        await fs.remove(path, prune=bucket)
     except FileNotFoundError:
         return web.Response(status=404)
-
-    parent = path.parent
-    while parent != bucket:
-        if not await aiofiles.os.listdir(parent):
-            await aiofiles.os.rmdir(parent)
-            parent = parent.parent
-        else:
-            break
-
     return web.Response(status=204)
 
 
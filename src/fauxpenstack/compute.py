@@ -0,0 +1,421 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""What actually runs instances, picked by flavor."""
+import asyncio
+import ipaddress
+import logging
+import os
+import random
+import subprocess
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional, Set, Type
+
+import aiofiles
+
+from . import metrics, qmp
+from .placement import Pinning, cpus, set_affinity
+
+CONSOLES = Path("consoles")
+HUGEPAGES = Path("/dev/hugepages")
+BRIDGE_HELPERS = (
+    Path("/usr/lib/qemu/qemu-bridge-helper"),
+    Path("/usr/libexec/qemu-bridge-helper"),
+)
+
+# disk cache modes, as (direct, no-flush)
+CACHE_MODES = {
+    "none": (True, False),
+    "writeback": (False, False),
+    "unsafe": (False, True),
+}
+AIO_MODES = ("threads", "native", "io_uring")
+CPU_POLICIES = ("shared", "dedicated")
+# how long qemu has to answer before vCPUs stay unpinned, by tenths of a second
+PIN_ATTEMPTS = 100
+# extra specs -> qemu drive throttling
+THROTTLING = {
+    "quota:disk_read_bytes_sec": "bps-read",
+    "quota:disk_write_bytes_sec": "bps-write",
+    "quota:disk_total_bytes_sec": "bps-total",
+    "quota:disk_read_iops_sec": "iops-read",
+    "quota:disk_write_iops_sec": "iops-write",
+    "quota:disk_total_iops_sec": "iops-total",
+}
+
+# addresses of fake instances, from the benchmarking range
+FAKE_NETWORK = ipaddress.ip_network("198.18.0.0/15")
+
+
+def arp_table() -> Dict[str, str]:
+    """Addresses of the neighbours of the host, by mac."""
+    table = {}
+    with open("/proc/net/arp") as f:
+        f.readline()  # header
+        while entry := f.readline():
+            address, _, _, mac, *_ = entry.split()
+            table[mac.lower()] = address
+    return table
+
+
+class Tuning(NamedTuple):
+    """What the extra specs of a flavor ask of qemu."""
+
+    cache: Optional[str] = None
+    aio: Optional[str] = None
+    iothreads: int = 0
+    throttling: Dict[str, int] = {}
+    hugepages: bool = False
+    multiqueue: bool = False
+    dedicated: bool = False
+
+    @classmethod
+    def parse(cls, specs: Dict[str, str]) -> "Tuning":
+        """Tuning out of extra specs, ValueError if they make no sense."""
+        cache = specs.get("qemu:disk_cache")
+        if cache is not None and cache not in CACHE_MODES:
+            raise ValueError(f"unknown qemu:disk_cache {cache!r}")
+        aio = specs.get("qemu:disk_aio")
+        if aio is not None and aio not in AIO_MODES:
+            raise ValueError(f"unknown qemu:disk_aio {aio!r}")
+        if aio == "native" and cache != "none":
+            raise ValueError("qemu:disk_aio native needs qemu:disk_cache none")
+        if (policy := specs.get("hw:cpu_policy", "shared")) not in CPU_POLICIES:
+            raise ValueError(f"unknown hw:cpu_policy {policy!r}")
+        return cls(
+            cache,
+            aio,
+            int(specs.get("qemu:iothreads", 0)),
+            {opt: int(specs[key]) for key, opt in THROTTLING.items() if key in specs},
+            specs.get("hw:mem_page_size", "small") not in ("small", "any"),
+            specs.get("hw:vif_multiqueue_enabled") == "true",
+            policy == "dedicated",
+        )
+
+    def drive_options(self) -> str:
+        options = ""
+        if self.cache:
+            options += f",cache={self.cache}"
+        if self.aio:
+            options += f",aio={self.aio}"
+        for option, value in self.throttling.items():
+            options += f",throttling.{option}={value}"
+        return options
+
+    def blockdev_options(self) -> dict:
+        """The same, for blockdev-add"""
+        options: dict = {}
+        if self.cache:
+            direct, no_flush = CACHE_MODES[self.cache]
+            options["cache"] = {"direct": direct, "no-flush": no_flush}
+        if self.aio:
+            options["aio"] = self.aio
+        return options
+
+
+def blk_device(arch: str) -> str:
+    return "virtio-blk-ccw" if arch == "s390x" else "virtio-blk-pci"
+
+
+def _bridge_helper() -> Optional[Path]:
+    return next((helper for helper in BRIDGE_HELPERS if helper.exists()), None)
+
+
+class Driver(ABC):
+    """Runs a single instance.
+
+    Drivers don't keep a reference to their instance, instances get
+    cleaned up when the last reference to them goes away.
+    """
+
+    # boots a guest from a volume, with a config drive and metadata for it
+    guest = True
+
+    def __init__(self, flavor: dict):
+        self.flavor = flavor
+        self.tuning = Tuning.parse(flavor.get("extra_specs", {}))
+
+    @abstractmethod
+    async def spawn(self, instance, arch: str) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def stop(self) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def status(self) -> str:
+        """ACTIVE, BUILD or ERROR"""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def console(self) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    def address(self, arp: Optional[Dict[str, str]] = None) -> Optional[str]:
+        """Address of the instance on its bridge, if known.
+
+        arp is a recent arp_table(), when checking many instances at once.
+        """
+        raise NotImplementedError
+
+
+class QemuDriver(Driver):
+    """A qemu process per instance, the real thing."""
+
+    def __init__(self, flavor: dict):
+        super().__init__(flavor)
+        self._sub: Optional[subprocess.Popen] = None
+        self._console: Optional[Path] = None
+        self._qmp: Optional[Path] = None
+        self._hwadd: Optional[str] = None
+        self._owner: Optional[str] = None
+        self._pinning: Optional[Pinning] = None
+        self._pinner: Optional[asyncio.Task] = None
+
+    async def spawn(self, instance, arch: str) -> None:
+        tuning = self.tuning
+        self._owner = instance.id
+        if tuning.dedicated:
+            self._pinning = cpus.dedicate(instance.id, self.flavor["vcpus"])
+        self._console = CONSOLES / instance.id
+        self._qmp = instance._qmp
+        self._hwadd = instance._br_hwadd
+        nic_model = "virtio-net-pci"
+        if arch == "s390x":
+            nic_model = "virtio"
+        root = f"file={instance._volume}{tuning.drive_options()}"
+
+        args = [
+            f"qemu-system-{arch}",
+            "-nographic",
+            "-uuid",
+            instance.id,
+            "-serial",
+            f"file:{self._console}",
+            "-qmp",
+            f"unix:{self._qmp},server=on,wait=off",
+        ]
+        if tuning.iothreads:
+            for n in range(tuning.iothreads):
+                args.extend(["-object", f"iothread,id=io{n}"])
+            args.extend(["-drive", f"{root},if=none,id=root"])
+            args.append("-device")
+            args.append(f"{blk_device(arch)},drive=root,iothread=io0,bootindex=0")
+        else:
+            args.extend(["-drive", f"{root},if=virtio"])
+        args += [
+            "-drive",
+            f"file={instance._drive},format=raw,if=virtio,readonly=on",
+            "-m",
+            f"{self.flavor['ram']}M",
+            # metadata-only network
+            "-nic",
+            f"user,hostname={instance.hostname},model={nic_model},net=169.254.169.0/24,restrict=on,"
+            f"guestfwd=tcp:169.254.169.254:80-unix:{instance._meta.absolute()}",
+        ]
+
+        match arch:
+            case "x86_64":
+                args.append("-enable-kvm")
+                args.extend(
+                    # pants on fire
+                    ["-smbios", "type=1,product=OpenStack Compute"]
+                )
+            case "aarch64":
+                # impdef is "less secure" but way faster
+                args.extend(["-machine", "virt", "-cpu", "max,pauth-impdef=on"])
+                args.extend(["-bios", "/usr/share/qemu-efi-aarch64/QEMU_EFI.fd"])
+
+        if (ncpus := self.flavor["vcpus"]) > 1:
+            args.append("-smp")
+            args.append(str(ncpus))
+
+        if pinning := self._pinning:
+            backend = "memory-backend-ram"
+            if tuning.hugepages:
+                backend = f"memory-backend-file,mem-path={HUGEPAGES},prealloc=on"
+            args.append("-object")
+            args.append(
+                f"{backend},id=ram,size={self.flavor['ram']}M,"
+                f"host-nodes={pinning.node},policy=bind"
+            )
+            args.extend(["-machine", "memory-backend=ram"])
+        elif tuning.hugepages:
+            args.extend(["-mem-path", str(HUGEPAGES), "-mem-prealloc"])
+
+        # The bridge helper can't open multiqueue taps, the next best
+        # thing is moving packets in the kernel with vhost-net.
+        if instance._br and tuning.multiqueue and (helper := _bridge_helper()):
+            device = "virtio-net-ccw" if arch == "s390x" else "virtio-net-pci"
+            args.append("-netdev")
+            args.append(f"tap,id=br0,helper={helper} --br={instance._br},vhost=on")
+            args.extend(["-device", f"{device},netdev=br0,mac={self._hwadd}"])
+        elif instance._br:
+            args.append("-nic")
+            args.append(f"bridge,model={nic_model},br={instance._br},mac={self._hwadd}")
+        logging.debug("spawning %r", args)
+
+        # del and async don't play together.
+        with metrics.QEMU_SPAWN.labels().time():
+            self._sub = subprocess.Popen(
+                args, stdin=open("/dev/null"), stdout=open("/dev/null", "w")
+            )
+        if self._pinning:
+            set_affinity(self._sub.pid, self._pinning.cores)
+            self._pinner = asyncio.create_task(self._pin_vcpus())
+        else:
+            cpus.share(instance.id, self._sub.pid)
+
+    async def _pin_vcpus(self) -> None:
+        """A dedicated core per vCPU thread, once qemu tells which they are."""
+        for _ in range(PIN_ATTEMPTS):
+            try:
+                vcpus = await qmp.execute(self._qmp, "query-cpus-fast")
+                break
+            except qmp.QMPError:
+                await asyncio.sleep(0.1)
+        else:
+            logging.warning("could not pin the vCPUs of %s", self._owner)
+            return
+        vcpus.sort(key=lambda vcpu: vcpu["cpu-index"])
+        for vcpu, core in zip(vcpus, sorted(self._pinning.cores)):
+            try:
+                os.sched_setaffinity(vcpu["thread-id"], {core})
+            except OSError:
+                pass
+
+    def stop(self) -> None:
+        if self._pinner:
+            self._pinner.cancel()
+        if self._owner:
+            cpus.release(self._owner)
+
+        for path in (self._console, self._qmp):
+            try:
+                os.remove(path)
+            except (OSError, TypeError):
+                pass
+
+        if self._sub:
+            try:
+                self._sub.kill()
+                # reap zombies
+                self._sub.communicate()
+                self._sub = None
+            except Exception:
+                pass
+
+    def status(self) -> str:
+        if self._sub and self._sub.poll() is not None:
+            return "ERROR"
+        return "ACTIVE"
+
+    async def console(self) -> str:
+        async with aiofiles.open(self._console) as f:
+            return await f.read()
+
+    def address(self, arp: Optional[Dict[str, str]] = None) -> Optional[str]:
+        """bridged arp lookup"""
+        if not self._hwadd:
+            return None
+        if arp is None:
+            arp = arp_table()
+        return arp.get(self._hwadd)
+
+
+_fake_addresses: Set[int] = set()
+
+BOOT_LOG = (
+    (0.0, "Linux version 6.1.0-fauxpenstack (fake@{hostname})"),
+    (0.05, "Command line: root=LABEL=cloudimg-rootfs console=ttyS0"),
+    (0.3, "Run /sbin/init as init process"),
+    (0.6, "cloud-init: Cloud-init running 'init' for {id}"),
+    (0.8, "ci-info: | eth0 | True | {address} | 255.254.0.0 |"),
+    (1.0, "{hostname} login: "),
+)
+
+
+class FakeDriver(Driver):
+    """Instances that only pretend to boot, in process.
+
+    They take boot_time seconds (from the flavor, give or take 20%) to
+    become active and get an address, and tell as much on their console.
+    """
+
+    guest = False
+
+    def __init__(self, flavor: dict):
+        super().__init__(flavor)
+        self._boot_time = float(flavor.get("boot_time", 0)) * random.uniform(0.8, 1.2)
+        self._started = 0.0
+        self._address: Optional[int] = None
+        self._facts: Dict[str, str] = {}
+
+    async def spawn(self, instance, arch: str) -> None:
+        self._started = time.monotonic()
+        self._facts = {"id": instance.id, "hostname": instance.hostname}
+        first = int(FAKE_NETWORK.network_address) + 1
+        size = FAKE_NETWORK.num_addresses - 2
+        if len(_fake_addresses) >= size:
+            logging.warning("out of fake addresses, %s stays without", instance.id)
+            return
+        address = first + random.randrange(size)
+        while address in _fake_addresses:
+            address = first + random.randrange(size)
+        _fake_addresses.add(address)
+        self._address = address
+        self._facts["address"] = str(ipaddress.ip_address(address))
+
+    def stop(self) -> None:
+        if self._address is not None:
+            _fake_addresses.discard(self._address)
+            self._address = None
+
+    def _uptime(self) -> float:
+        return time.monotonic() - self._started
+
+    def status(self) -> str:
+        return "ACTIVE" if self._uptime() >= self._boot_time else "BUILD"
+
+    async def console(self) -> str:
+        uptime = self._uptime()
+        facts = {"address": "-", **self._facts}
+        return "".join(
+            f"[{at * self._boot_time:12.6f}] {line.format(**facts)}\n"
+            for at, line in BOOT_LOG
+            if at * self._boot_time <= uptime
+        )
+
+    def address(self, arp: Optional[Dict[str, str]] = None) -> Optional[str]:
+        if self.status() != "ACTIVE":
+            return None
+        return self._facts.get("address")
+
+
+DRIVERS: Dict[str, Type[Driver]] = {
+    "qemu": QemuDriver,
+    "fake": FakeDriver,
+}
+
+
+def driver_class(flavor: dict) -> Type[Driver]:
+    """What runs instances of a flavor, qemu unless it says otherwise."""
+    return DRIVERS[flavor.get("driver", "qemu")]
+
+
+def driver(flavor: dict) -> Driver:
+    return driver_class(flavor)(flavor)
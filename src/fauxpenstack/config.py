@@ -0,0 +1,90 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""conf.toml, and whatever we derive from it."""
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import toml
+
+from .compute import DRIVERS, Tuning
+from .middlewares import AclTable, Limiter
+from .neutrino import Subnet
+from .placement import parse_cpulist
+
+
+def _spec(value) -> str:
+    """Extra specs are strings in the API, toml has booleans and numbers."""
+    if isinstance(value, bool):
+        return str(value).lower()
+    return str(value)
+
+
+def _missing(data: dict, required: List[Tuple[str, ...]]) -> Optional[str]:
+    """First of the required key paths data doesn't have, dotted."""
+    for path in required:
+        section = data
+        for key in path:
+            if not isinstance(section, dict) or key not in section:
+                return ".".join(path)
+            section = section[key]
+    return None
+
+
+class Config(dict):
+    """A conf.toml snapshot.
+
+    Never modified once loaded, a reload builds a new one which is swapped
+    in, so requests keep using the one they started with.
+    """
+
+    def __init__(self, data: dict):
+        super().__init__(data)
+        required = [("secret_key",), ("acls",), ("roles",)]
+        for name in self.get("flavors", {}):
+            required += [("flavors", name, key) for key in ("vcpus", "ram", "disk")]
+        for network in self.get("net_subnets", {}):
+            required.append(("net_bridges", network))
+        missing = _missing(self, required)
+        if missing:
+            raise ValueError(f"invalid configuration: missing {missing}")
+        for name, flavor in self.get("flavors", {}).items():
+            if (driver := flavor.get("driver", "qemu")) not in DRIVERS:
+                raise ValueError(
+                    f"invalid configuration: unknown driver {driver!r} for flavor {name}"
+                )
+        try:
+            self.acl = AclTable(self)
+            for flavor in self.get("flavors", {}).values():
+                if "extra_specs" in flavor:
+                    flavor["extra_specs"] = {
+                        k: _spec(v) for k, v in flavor["extra_specs"].items()
+                    }
+            self.flavors = [
+                {"name": k, "id": k, **v} for k, v in self.get("flavors", {}).items()
+            ]
+            for flavor in self.flavors:
+                Tuning.parse(flavor.get("extra_specs", {}))
+            parse_cpulist(self.get("placement", {}).get("reserved_cpus", ""))
+            Limiter.settings(self.get("limits", {}))
+            for network, subnet in self.get("net_subnets", {}).items():
+                Subnet(network, **subnet)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"invalid configuration: {e!r}")
+
+    @classmethod
+    def load(cls, path: Path) -> "Config":
+        try:
+            return cls(toml.load(path))
+        except toml.TomlDecodeError as e:
+            raise ValueError(str(e))
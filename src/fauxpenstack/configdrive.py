@@ -0,0 +1,71 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Config drives, shared by instances when their content is the same."""
+import asyncio
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict
+from uuid import uuid4
+
+from aiohttp import web
+
+from . import iso9660
+
+DRIVES = Path("configdrives")
+LABEL = "config-2"
+
+# drive -> number of instances using it
+_users: Dict[Path, int] = {}
+
+
+def _digest(files: Dict[str, bytes]) -> str:
+    digest = hashlib.sha256()
+    for path in sorted(files):
+        digest.update(f"{path}\0{len(files[path])}\0".encode("utf-8"))
+        digest.update(files[path])
+    return digest.hexdigest()
+
+
+async def acquire(files: Dict[str, bytes]) -> Path:
+    """Get a drive holding files, building it if nobody has one already."""
+    drive = DRIVES / f"{_digest(files)}.iso"
+    _users[drive] = _users.get(drive, 0) + 1
+    if drive.exists():
+        return drive
+    tmp = DRIVES / f".{uuid4()}.iso"
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            None, iso9660.create, tmp, LABEL, files
+        )
+        os.replace(tmp, drive)
+    except Exception:
+        tmp.unlink(missing_ok=True)
+        release(drive)
+        raise
+    return drive
+
+
+def release(drive: Path) -> None:
+    users = _users.pop(drive) - 1
+    if users:
+        _users[drive] = users
+    else:
+        drive.unlink(missing_ok=True)
+
+
+async def clear(app: web.Application) -> None:
+    """Drop drives left over by a previous run, their instances are gone."""
+    for drive in DRIVES.glob("*.iso"):
+        drive.unlink()
@@ -0,0 +1,108 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Numbered events, for clients waiting on changes instead of polling."""
+import asyncio
+import collections
+import time
+from itertools import islice
+from typing import Callable, List, Optional
+
+from aiohttp import web
+
+from .util import encode
+
+REPLAY = 1000
+# SSE comment sent on quiet streams, so proxies don't hang up
+KEEPALIVE = 15.0
+
+
+class Bus:
+    """Events numbered from 1, the last few kept for readers catching up."""
+
+    def __init__(self, size: int = REPLAY):
+        self.events: collections.deque = collections.deque(maxlen=size)
+        self.seq = 0
+        self._published = asyncio.Event()
+        self.waiting = 0
+        # called as someone starts waiting, to get producers going
+        self.on_wait: Optional[Callable[[], None]] = None
+
+    def publish(self, kind: str, **data) -> None:
+        self.seq += 1
+        self.events.append(
+            {"seq": self.seq, "event": kind, "time": time.time(), **data}
+        )
+        # wake up everyone waiting, later waiters get a fresh one
+        self._published.set()
+        self._published = asyncio.Event()
+
+    def since(self, seq: int) -> Optional[List[dict]]:
+        """Events after seq, None if some of them were dropped already.
+
+        seq from the future is from before a restart, and just as stale.
+        """
+        oldest = self.events[0]["seq"] if self.events else self.seq + 1
+        if seq > self.seq or seq + 1 < oldest:
+            return None
+        return list(islice(self.events, seq + 1 - oldest, None))
+
+    async def wait(self, seq: int, timeout: float) -> Optional[List[dict]]:
+        """since, waiting up to timeout for it to have something."""
+        events = self.since(seq)
+        if events == []:
+            self.waiting += 1
+            try:
+                if self.on_wait:
+                    self.on_wait()
+                await asyncio.wait_for(self._published.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.waiting -= 1
+            events = self.since(seq)
+        return events
+
+
+async def stream(request: web.Request, bus: Bus, seq: int) -> web.StreamResponse:
+    """Server-Sent Events after seq, until the client goes away.
+
+    Readers too far behind get a reset event, and carry on from the latest.
+    """
+    response = web.StreamResponse(
+        headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+    )
+    await response.prepare(request)
+    try:
+        while True:
+            events = await bus.wait(seq, KEEPALIVE)
+            if events is None:
+                seq = bus.seq
+                await response.write(b"id: %d\nevent: reset\ndata: {}\n\n" % seq)
+            elif not events:
+                # a client waiting is a client using us
+                request.config_dict["last_request"][0] = time.time()
+                await response.write(b": keepalive\n\n")
+            else:
+                chunk = bytearray()
+                for event in events:
+                    chunk += b"id: %d\nevent: %s\ndata: %s\n\n" % (
+                        event["seq"],
+                        event["event"].encode(),
+                        encode(event),
+                    )
+                seq = events[-1]["seq"]
+                await response.write(chunk)
+    except ConnectionResetError:
+        pass
+    return response
@@ -0,0 +1,148 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Filesystem metadata in batches, on threads of its own.
+
+Directories are read with os.scandir, up to BATCH entries per executor
+job, so listing costs a thread hop per directory rather than one per file.
+The threads are separate from the default executor, slow disks don't hold
+up everything else running there.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+from typing import AsyncIterator, Callable, Iterable, List, Optional, Tuple, Union
+
+THREADS = 8
+BATCH = 1024
+
+_pool = ThreadPoolExecutor(THREADS, thread_name_prefix="fs")
+
+StrPath = Union[str, Path]
+
+
+async def run(fn: Callable, *args):
+    """Run a blocking filesystem call on the fs threads."""
+    return await asyncio.get_running_loop().run_in_executor(_pool, fn, *args)
+
+
+def _batch(entries, stat: bool) -> Tuple[List[os.DirEntry], bool]:
+    """Up to BATCH entries, and whether there are no more."""
+    batch = list(islice(entries, BATCH))
+    done = len(batch) < BATCH
+    if stat:
+        stated = []
+        for entry in batch:
+            try:
+                entry.stat()  # DirEntry caches it, later calls are free
+            except FileNotFoundError:
+                continue  # removed since
+            stated.append(entry)
+        batch = stated
+    return batch, done
+
+
+def _open(path: StrPath, stat: bool):
+    entries = os.scandir(path)
+    try:
+        return entries, *_batch(entries, stat)
+    except BaseException:
+        entries.close()
+        raise
+
+
+async def batches(
+    path: StrPath, stat: bool = False
+) -> AsyncIterator[List[os.DirEntry]]:
+    """Entries of a directory, BATCH at a time.
+
+    With stat, their stat() is already cached and doesn't block.
+    """
+    entries, batch, done = await run(_open, path, stat)
+    try:
+        while True:
+            yield batch
+            if done:
+                break
+            batch, done = await run(_batch, entries, stat)
+    finally:
+        entries.close()
+
+
+async def scandir(path: StrPath, stat: bool = False) -> AsyncIterator[os.DirEntry]:
+    """Entries of a directory, stat'ed too if asked."""
+    async for batch in batches(path, stat):
+        for entry in batch:
+            yield entry
+
+
+async def walk(
+    top: StrPath, stat: bool = False
+) -> AsyncIterator[Tuple[str, List[os.DirEntry]]]:
+    """Files under top by directory, in the order of os.walk.
+
+    Big directories come in several batches. Like os.walk, symlinked
+    directories aren't followed and unreadable directories are skipped.
+    """
+    pending = [str(top)]
+    while pending:
+        directory = pending.pop()
+        subdirs = []
+        try:
+            async for batch in batches(directory, stat):
+                files = []
+                for entry in batch:
+                    if not entry.is_dir():
+                        files.append(entry)
+                    elif not entry.is_symlink():
+                        subdirs.append(entry.path)
+                yield directory, files
+        except OSError:
+            continue
+        pending.extend(reversed(subdirs))
+
+
+def _stats(paths: List[StrPath]) -> List[Optional[os.stat_result]]:
+    stats = []
+    for path in paths:
+        try:
+            stats.append(os.stat(path))
+        except FileNotFoundError:
+            stats.append(None)
+    return stats
+
+
+async def stats(paths: Iterable[StrPath]) -> AsyncIterator[Optional[os.stat_result]]:
+    """stat of each path, None for those which are gone, BATCH at a time."""
+    paths = iter(paths)
+    while batch := list(islice(paths, BATCH)):
+        for stat in await run(_stats, batch):
+            yield stat
+
+
+def _remove(path: Path, prune: Optional[Path]) -> None:
+    os.remove(path)
+    parent = path.parent
+    while prune and parent != prune:
+        try:
+            os.rmdir(parent)
+        except OSError:
+            break  # not empty
+        parent = parent.parent
+
+
+async def remove(path: Path, prune: Optional[Path] = None) -> None:
+    """Remove a file, then directories left empty up to prune."""
+    await run(_remove, path, prune)
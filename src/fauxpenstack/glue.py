@@ -12,16 +12,25 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """glue holds things together, kinda like a keystone does."""
+import asyncio
 import base64
 import binascii
+import functools
 import hashlib
 import hmac
 import json
 import logging
+import os
+import secrets
+import time
 from datetime import datetime, timedelta, timezone
-from typing import Any
+from pathlib import Path
+from typing import Any, Dict, Optional, Set, Tuple
+from uuid import uuid4
 
+import aiofiles
 from aiohttp import web
+
 from . import util
 
 routes = web.RouteTableDef()
@@ -32,12 +41,98 @@ util.make_endpoint(routes, "3.0", "v3")
 
 
 REGION = "default"
+# how many already verified tokens to remember
+VERIFIED_TOKENS = 1024
 
 
 class InvalidTokenError(Exception):
     pass
 
 
+class RevocationList:
+    """Ids of revoked tokens, bucketed by the hour their token expires.
+
+    Lookups only touch the bucket of the token expiry, and whole buckets
+    get dropped once their tokens are expired anyway, as the hour changes.
+    """
+
+    BUCKET = 3600
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._buckets: Dict[int, Set[str]] = {}
+        self._mtime = 0
+        self._pruned: Optional[int] = None  # hour of the last prune
+
+    def __contains__(self, token: Tuple[str, float]) -> bool:
+        self._prune_hourly()
+        token_id, expires = token
+        return token_id in self._buckets.get(int(expires) // self.BUCKET, ())
+
+    def add(self, token_id: str, expires: float) -> None:
+        self._prune_hourly()
+        self._buckets.setdefault(int(expires) // self.BUCKET, set()).add(token_id)
+
+    def prune(self) -> None:
+        current = self._pruned = int(time.time()) // self.BUCKET
+        for bucket in [b for b in self._buckets if b < current]:
+            del self._buckets[bucket]
+
+    def _prune_hourly(self) -> None:
+        if int(time.time()) // self.BUCKET != self._pruned:
+            self.prune()
+
+    async def load(self) -> None:
+        try:
+            async with aiofiles.open(self.path) as f:
+                data = json.loads(await f.read())
+        except FileNotFoundError:
+            return
+        self._buckets = {int(k): set(v) for k, v in data.items()}
+        self.prune()
+
+    def _changed(self) -> Optional[dict]:
+        """What is saved, if it changed since last read."""
+        try:
+            mtime = self.path.stat().st_mtime_ns
+            if mtime == self._mtime:
+                return None
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._mtime = mtime
+        return data
+
+    async def watch(self) -> None:
+        """Pick up revocations saved by another process, checking every second."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(1)
+            data = await loop.run_in_executor(None, self._changed)
+            if data is not None:
+                # ours may have some not saved yet, or already pruned
+                for k, v in data.items():
+                    self._buckets.setdefault(int(k), set()).update(v)
+                self._pruned = None
+
+    async def save(self) -> None:
+        self.prune()
+        data = {k: sorted(v) for k, v in self._buckets.items()}
+        # swapped in whole, so readers never get half of it
+        tmp = self.path.with_name(f".{uuid4()}.json")
+        try:
+            async with aiofiles.open(tmp, "w") as f:
+                await f.write(json.dumps(data))
+            os.replace(tmp, self.path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+
+revoked = RevocationList(Path("revoked_tokens.json"))
+
+
 def catalog(request: web.Request):
     base = request.config_dict.get("base_url")
     if not base:
@@ -71,18 +166,89 @@ def decode_token(key: str, token: str) -> Any:
     b_key: bytes = key.encode("utf-8")
     try:
         data, h = base64.b64decode(token.encode("ascii")).split(b"~~~")
-    except binascii.Error:
+    except (binascii.Error, ValueError):
         raise InvalidTokenError
     h2 = hmac.new(b_key, data, hashlib.sha256).hexdigest().encode("ascii")
-    if h2 != h:
+    if not hmac.compare_digest(h2, h):
         raise InvalidTokenError
     return json.loads(data)
 
 
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _unb64(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def encode_compact_token(key: str, user: str, expires: datetime) -> str:
+    """Make a slim token, only holding a signed user, expiry and nonce.
+
+    Looks like "<expiry>.<nonce>.<user>.<signature>", everything else lives
+    server-side.
+    """
+    user_b64 = _b64(user.encode("utf-8"))
+    claims = f"{int(expires.timestamp()):x}.{secrets.token_urlsafe(9)}.{user_b64}"
+    h = hmac.new(key.encode("utf-8"), claims.encode("ascii"), hashlib.sha256)
+    return f"{claims}.{_b64(h.digest())}"
+
+
+def decode_compact_token(key: str, token: str) -> Tuple[str, float, str]:
+    """Check a compact token, returning its user, expiry and nonce."""
+    claims, _, sig = token.rpartition(".")
+    try:
+        expires, nonce, user = claims.split(".")
+        # cheap enough to be done before the hmac
+        if int(expires, 16) < time.time():
+            raise InvalidTokenError
+        h = hmac.new(key.encode("utf-8"), claims.encode("ascii"), hashlib.sha256)
+        if not hmac.compare_digest(h.digest(), _unb64(sig)):
+            raise InvalidTokenError
+        return _unb64(user).decode("utf-8"), int(expires, 16), nonce
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidTokenError
+
+
+@functools.lru_cache(maxsize=VERIFIED_TOKENS)
+def verify_token(key: str, token: str) -> Tuple[str, float, str]:
+    """Validate any kind of token, returning its user, expiry and id.
+
+    Results are cached so repeated requests don't pay for hmac and parsing,
+    which means expiry and revocation must still be checked by the caller.
+    """
+    if "." in token:
+        return decode_compact_token(key, token)
+    data = decode_token(key, token)
+    try:
+        expires = datetime.fromisoformat(data["expires_at"]).timestamp()
+        user = data["user"]["name"]
+    except (KeyError, TypeError, ValueError):
+        raise InvalidTokenError
+    return user, expires, hashlib.sha1(token.encode("ascii")).hexdigest()
+
+
+def authenticate(key: str, token: str) -> Tuple[str, float, str]:
+    """Like verify_token, but also rejects expired and revoked tokens."""
+    user, expires, token_id = verify_token(key, token)
+    if expires < time.time() or (token_id, expires) in revoked:
+        raise InvalidTokenError
+    return user, expires, token_id
+
+
+def token_data(request: web.Request, user: str, expires: datetime) -> dict:
+    return {
+        "methods": ["password"],
+        "user": {"name": user, "id": user},
+        "expires_at": expires.isoformat("T", "seconds"),
+        "catalog": catalog(request),
+    }
+
+
 @routes.post("/v3/auth/tokens")
 async def auth(request: web.Request):
     data = await request.json()
-    app_config = request.config_dict["app_config"]
+    app_config = request["app_config"]
     try:
         user = data["auth"]["identity"]["password"]["user"]
         username = user.get("name") or user["id"]
@@ -99,26 +265,62 @@ async def auth(request: web.Request):
         logging.error("unsupported auth method")
         return web.Response(status=401)
 
-    token_data = {
-        "methods": ["password"],
-        "user": {"name": username, "id": username},
-        "expires_at": (datetime.now(timezone.utc) + timedelta(hours=1)).isoformat(
-            "T", "seconds"
-        ),
-        "catalog": catalog(request),
-    }
-    token = encode_token(app_config["secret_key"], token_data)
-    return web.json_response(
-        {"token": token_data},
+    expires = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(hours=1)
+    data = token_data(request, username, expires)
+    if app_config.get("token_format") == "compact":
+        token = encode_compact_token(app_config["secret_key"], username, expires)
+    else:
+        token = encode_token(app_config["secret_key"], data)
+    return util.json_response(
+        {"token": data},
         status=201,
         headers={"X-Subject-Token": token},
     )
 
 
+@routes.get("/v3/auth/tokens")
+async def validate(request: web.Request) -> web.Response:
+    token = request.headers.get("X-Subject-Token", "")
+    try:
+        user, expires, _ = authenticate(request["app_config"]["secret_key"], token)
+    except InvalidTokenError:
+        return web.Response(status=404)
+    expires_at = datetime.fromtimestamp(expires, timezone.utc)
+    return util.json_response(
+        {"token": token_data(request, user, expires_at)},
+        headers={"X-Subject-Token": token},
+    )
+
+
+@routes.delete("/v3/auth/tokens")
+async def revoke(request: web.Request) -> web.Response:
+    try:
+        _, expires, token_id = authenticate(
+            request["app_config"]["secret_key"],
+            request.headers.get("X-Subject-Token", ""),
+        )
+    except InvalidTokenError:
+        return web.Response(status=404)
+    revoked.add(token_id, expires)
+    await revoked.save()
+    return web.Response(status=204)
+
+
+async def _load_revoked(app: web.Application) -> None:
+    await revoked.load()
+    app["revoked_watch"] = asyncio.create_task(revoked.watch())
+
+
+async def _stop_revoked(app: web.Application) -> None:
+    app["revoked_watch"].cancel()
+
+
 @routes.post("/v3/tokens")
 async def no_v2(request: web.Request) -> web.Response:
     logging.error("Query to identity v2 should be considered obsolete.")
     return web.Response(status=400)
 
 
+app.on_startup.append(_load_revoked)
+app.on_cleanup.append(_stop_revoked)
 app.add_routes(routes)
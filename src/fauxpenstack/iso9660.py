@@ -0,0 +1,242 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Small ISO9660 images, written by hand instead of forking genisoimage.
+
+Only what a config drive needs: a handful of small files, with a Joliet
+tree so guests see their real (long, lowercase) names. Dates are left
+unspecified, so the same files always make the same image.
+"""
+import re
+import struct
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+SECTOR = 2048
+# system area, then one sector each for the primary, Joliet and terminator
+# volume descriptors, then little and big endian path tables for both.
+PRIMARY_LBA = 16
+PATH_TABLES_LBA = 19
+FIRST_FREE_LBA = 23
+
+NO_DATE = b"0" * 16 + b"\0"
+JOLIET_ESCAPE = b"%/E"  # UCS-2 level 3
+
+_NOT_D_CHARS = re.compile(r"[^A-Z0-9_]")
+
+
+def _both16(n: int) -> bytes:
+    return struct.pack("<H", n) + struct.pack(">H", n)
+
+
+def _both32(n: int) -> bytes:
+    return struct.pack("<I", n) + struct.pack(">I", n)
+
+
+def _sectors(size: int) -> int:
+    return -(-size // SECTOR)
+
+
+def _primary_name(name: str, is_dir: bool) -> bytes:
+    """Level 2 names, uppercase d-characters only."""
+    if is_dir:
+        return _NOT_D_CHARS.sub("_", name.upper())[:31].encode("ascii")
+    base, dot, ext = name.upper().rpartition(".")
+    if not dot:
+        base, ext = ext, ""
+    base = _NOT_D_CHARS.sub("_", base)
+    ext = _NOT_D_CHARS.sub("_", ext)[:8]
+    return f"{base[:28 - len(ext)]}.{ext};1".encode("ascii")
+
+
+def _joliet_name(name: str, is_dir: bool) -> bytes:
+    return name[:64].encode("utf-16-be")
+
+
+def _record(name: bytes, extent: int, size: int, is_dir: bool) -> bytes:
+    pad = b"\0" if len(name) % 2 == 0 else b""
+    return (
+        struct.pack("<BB", 33 + len(name) + len(pad), 0)
+        + _both32(extent)
+        + _both32(size)
+        + bytes(7)  # no date
+        + struct.pack("<BBB", 2 if is_dir else 0, 0, 0)
+        + _both16(1)
+        + struct.pack("<B", len(name))
+        + name
+        + pad
+    )
+
+
+def _pack(records: List[bytes]) -> bytes:
+    """Lay out directory records, without any crossing a sector boundary."""
+    out = bytearray()
+    for record in records:
+        if len(out) % SECTOR + len(record) > SECTOR:
+            out += bytes(-len(out) % SECTOR)
+        out += record
+    return bytes(out + bytes(-len(out) % SECTOR))
+
+
+def _path_table(
+    order: List[str], names: Dict[str, bytes], extents: Dict[str, int], fmt: str
+) -> bytes:
+    out = bytearray()
+    numbers = {}
+    for number, path in enumerate(order, 1):
+        numbers[path] = number
+        parent = numbers[path.rpartition("/")[0]] if path else 1
+        name = names[path]
+        out += struct.pack(f"{fmt}BBIH", len(name), 0, extents[path], parent)
+        out += name + (b"\0" if len(name) % 2 else b"")
+    return bytes(out)
+
+
+def _descriptor(
+    type: int,
+    label: bytes,
+    sectors: int,
+    root: bytes,
+    path_table: Tuple[int, int, int],
+    escape: bytes = b"",
+    blank: bytes = b" ",
+) -> bytes:
+    def _blank(size: int) -> bytes:
+        return (blank * size)[:size]
+
+    size, l_table, m_table = path_table
+    out = (
+        struct.pack("<B5sBB", type, b"CD001", 1, 0)
+        + _blank(32)  # system identifier
+        + (label + _blank(32))[:32]
+        + bytes(8)
+        + _both32(sectors)
+        + escape.ljust(32, b"\0")
+        + _both16(1)  # volume set size
+        + _both16(1)  # volume sequence number
+        + _both16(SECTOR)
+        + _both32(size)
+        + struct.pack("<II", l_table, 0)
+        + struct.pack(">II", m_table, 0)
+        + root
+        + _blank(128 * 4)  # volume set, publisher, preparer, application
+        + _blank(37 * 3)  # copyright, abstract and bibliographic files
+        + NO_DATE * 4
+        + b"\x01"  # file structure version
+    )
+    return out.ljust(SECTOR, b"\0")
+
+
+def _put(out: bytearray, lba: int, data: bytes) -> None:
+    out[lba * SECTOR : lba * SECTOR + len(data)] = data
+
+
+def image(label: str, files: Dict[str, bytes]) -> bytes:
+    """Build an image holding files, by /-separated path."""
+    children: Dict[str, List[str]] = {"": []}
+    for path in files:
+        parts = path.split("/")
+        for depth in range(1, len(parts)):
+            parent, directory = "/".join(parts[: depth - 1]), "/".join(parts[:depth])
+            if directory not in children:
+                children[directory] = []
+                children[parent].append(directory)
+        children["/".join(parts[:-1])].append(path)
+    # breadth first, which the path tables need
+    order = sorted(children, key=lambda d: (d.count("/") + bool(d), d.split("/")))
+
+    def _records(
+        naming: Callable, extents: Dict[str, int], sizes: Dict[str, int]
+    ) -> Dict[str, bytes]:
+        directories = {}
+        for directory in order:
+            parent = directory.rpartition("/")[0]
+            entries = sorted(
+                (naming(child.rpartition("/")[2], child in children), child)
+                for child in children[directory]
+            )
+            directories[directory] = _pack(
+                [
+                    _record(b"\0", extents[directory], sizes[directory], True),
+                    _record(b"\1", extents[parent], sizes[parent], True),
+                ]
+                + [
+                    _record(name, extents[child], sizes[child], child in children)
+                    for name, child in entries
+                ]
+            )
+        return directories
+
+    sizes: Dict[str, int] = {path: len(data) for path, data in files.items()}
+    trees = []
+    lba = FIRST_FREE_LBA
+    for naming in (_primary_name, _joliet_name):
+        # records have a fixed size, so lay them out once to size directories
+        blank = dict.fromkeys(order, 0) | dict.fromkeys(files, 0)
+        tree_sizes = {
+            d: len(data) for d, data in _records(naming, blank, blank).items()
+        }
+        extents = {}
+        for directory in order:
+            extents[directory] = lba
+            lba += _sectors(tree_sizes[directory])
+        trees.append((naming, extents, tree_sizes))
+    file_extents = {}
+    for path, data in files.items():
+        file_extents[path] = lba
+        lba += _sectors(len(data))
+
+    out = bytearray(lba * SECTOR)
+    path_table_lba = PATH_TABLES_LBA
+    descriptors = []
+    for naming, extents, tree_sizes in trees:
+        extents |= file_extents
+        tree_sizes = tree_sizes | sizes
+        for directory, data in _records(naming, extents, tree_sizes).items():
+            _put(out, extents[directory], data)
+        names = {d: naming(d.rpartition("/")[2], True) for d in order if d}
+        names[""] = b"\0"
+        tables = []
+        for fmt in "<>":
+            table = _path_table(order, names, extents, fmt)
+            if len(table) > SECTOR:
+                raise ValueError("too many directories")
+            _put(out, path_table_lba, table)
+            tables.append(path_table_lba)
+            path_table_lba += 1
+        root = _record(b"\0", extents[""], tree_sizes[""], True)
+        descriptors.append((root, (len(table), *tables)))
+    for path, data in files.items():
+        _put(out, file_extents[path], data)
+
+    (root, tables), (joliet_root, joliet_tables) = descriptors
+    primary = _descriptor(1, label.encode("ascii"), lba, root, tables)
+    joliet = _descriptor(
+        2,
+        label.encode("utf-16-be"),
+        lba,
+        joliet_root,
+        joliet_tables,
+        JOLIET_ESCAPE,
+        b"\0 ",
+    )
+    terminator = struct.pack("<B5sB", 255, b"CD001", 1).ljust(SECTOR, b"\0")
+    _put(out, PRIMARY_LBA, primary + joliet + terminator)
+    return bytes(out)
+
+
+def create(path: Path, label: str, files: Dict[str, bytes]) -> None:
+    """Write an image holding files to path."""
+    data = image(label, files)
+    with open(path, "xb") as f:
+        f.write(data)
@@ -11,68 +11,189 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""metadata service, because config drives are boring."""
+"""metadata service, because config drives are boring.
+
+A single server answers for every instance. Each instance gets its own
+unix socket, which qemu connects to at boot and forwards the guest
+metadata traffic over, so the socket a request comes in on tells which
+instance is asking.
+"""
 import asyncio
 import base64
-import logging
-from typing import Callable, Tuple
+import hashlib
+import re
+from pathlib import Path
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
 
 import aiofiles
 from aiohttp import web
 
+from .util import encode
+
+# qemu connects once and never reconnects, so connections must stay up
+KEEPALIVE_TIMEOUT = 365 * 24 * 3600
+_VERSION = re.compile(r"\d{4}-\d\d-\d\d$")
+
+JSON = "application/json"
+AZ_NAME = "nova"
+
 routes = web.RouteTableDef()
 
 
-@routes.get("/openstack")
-async def metadata(request: web.Request) -> web.Response:
-    return web.json_response({})
+class Document(NamedTuple):
+    body: bytes
+    content_type: str
+    etag: str
 
 
-@routes.get("/openstack/{version}/vendor_data.json")
-@routes.get("/openstack/{version}/vendor_data2.json")
-async def vendor_data(request: web.Request) -> web.Response:
-    return web.json_response({})
+# socket path -> instance documents
+_instances: Dict[str, Dict[str, Document]] = {}
+_runner: Optional[web.AppRunner] = None
 
 
-@routes.get("/openstack/{version}/user_data")
-async def user_data(request: web.Request) -> web.Response:
-    data = request.config_dict["user_data"]
-    return web.Response(body=data)
+class _Connection:
+    """The qemu stream, as far as a single HTTP connection goes.
 
+    Closing it only hands the stream over to a new connection.
+    """
 
-@routes.get("/openstack/{version}/meta_data.json")
-async def meta_data(request: web.Request) -> web.Response:
-    data = request.config_dict["meta_data"]
-    logging.debug("metadata served: %r", data)
-    return web.json_response(data)
+    def __init__(self, stream: "_Stream", transport: asyncio.Transport):
+        self._stream = stream
+        self._transport = transport
+        self._closed = False
+        self._paused = False
 
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
 
-@routes.get("/openstack/{version}/network_data.json")
-async def network_data(request: web.Request) -> web.Response:
-    return web.json_response(
-        {
-            "links": [
-                {
-                    "id": "br_link0",
-                    "ethernet_mac_address": request.config_dict["hw_addr"],
-                    "type": "bridge",
-                }
-            ],
-            "networks": [
-                {
-                    "id": "network0",
-                    "link": "br_link0",
-                    "type": "ipv4_dhcp",
-                }
-            ],
-            "services": [],
-        }
-    )
+    def write(self, data) -> None:
+        if not self._closed:
+            self._transport.write(data)
+
+    def writelines(self, data) -> None:
+        if not self._closed:
+            self._transport.writelines(data)
+
+    def pause_reading(self) -> None:
+        self._paused = True
+        self._transport.pause_reading()
+
+    def resume_reading(self) -> None:
+        self._paused = False
+        self._transport.resume_reading()
+
+    def is_closing(self) -> bool:
+        return self._closed or self._transport.is_closing()
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._paused:
+            self._transport.resume_reading()
+        self._stream.reconnect(self)
+
+    abort = close
+
+
+class _Stream(asyncio.Protocol):
+    """qemu forwards every guest connection over the same stream.
+
+    A guest asking to close its connection, an HTTP/1.0 request or a bad
+    one would close it for all the following ones too, so the server gets
+    a new connection instead whenever it closes one.
+    """
+
+    def __init__(self, factory: Callable[[], asyncio.Protocol]):
+        self._factory = factory
+        self._transport: Optional[asyncio.Transport] = None
+        self._connection: Optional[_Connection] = None
+        self._handler: Optional[asyncio.Protocol] = None
+
+    def connection_made(self, transport) -> None:
+        self._transport = transport
+        self._connect()
+
+    def _connect(self) -> None:
+        self._connection = _Connection(self, self._transport)
+        self._handler = self._factory()
+        self._handler.connection_made(self._connection)
+
+    def reconnect(self, connection: _Connection) -> None:
+        if connection is not self._connection or self._transport.is_closing():
+            return
+        closed = self._handler
+        self._connect()
+        # not from within the handler closing
+        asyncio.get_running_loop().call_soon(closed.connection_lost, None)
+
+    def connection_lost(self, exc) -> None:
+        self._connection._closed = True
+        self._handler.connection_lost(exc)
+
+    def data_received(self, data: bytes) -> None:
+        self._handler.data_received(data)
+
+    def eof_received(self):
+        return self._handler.eof_received()
 
+    def pause_writing(self) -> None:
+        self._handler.pause_writing()
 
-async def mk_metadata(instance) -> Tuple[Callable, int]:
-    """spawn a metadata service. returns a closer and a port."""
+    def resume_writing(self) -> None:
+        self._handler.resume_writing()
 
+
+def _instance(request: web.Request) -> Dict[str, Document]:
+    try:
+        return _instances[request.transport.get_extra_info("sockname")]
+    except (AttributeError, KeyError):
+        raise web.HTTPNotFound()
+
+
+def _canonical(path: str) -> str:
+    """Map any metadata version to latest, and directories to no slash."""
+    parts = path.rstrip("/").split("/")
+    version = 2 if len(parts) > 2 and parts[1] == "openstack" else 1
+    if len(parts) > version and _VERSION.match(parts[version]):
+        parts[version] = "latest"
+    return "/".join(parts)
+
+
+def _document(body: bytes, content_type: str) -> Document:
+    return Document(body, content_type, hashlib.sha1(body).hexdigest())
+
+
+def _encode(content) -> Tuple[bytes, str]:
+    if isinstance(content, bytes):
+        return content, "application/octet-stream"
+    if isinstance(content, str):
+        return content.encode("utf-8"), "text/plain"
+    return encode(content), JSON
+
+
+def _render(files: Dict[str, object]) -> Dict[str, Document]:
+    """Every document of an instance, by canonical path."""
+    docs = {}
+    listings: Dict[str, dict] = {}
+    for path, content in files.items():
+        docs[path] = _document(*_encode(content))
+        # every parent directory lists what is in it
+        parent, _, name = path.rpartition("/")
+        while True:
+            listings.setdefault(parent, {})[name] = None
+            if not parent:
+                break
+            parent, _, name = parent.rpartition("/")
+            # versions are listed without a slash
+            name = name if name == "latest" else name + "/"
+    for path, names in listings.items():
+        docs[path] = _document("\n".join(names).encode("utf-8"), "text/plain")
+    return docs
+
+
+async def instance_files(instance) -> Dict[str, object]:
+    """The metadata files of an instance, by path."""
     meta_data = {
         "name": instance.name,
         "uuid": instance.id,
@@ -88,21 +209,105 @@ async def mk_metadata(instance) -> Tuple[Callable, int]:
         except FileNotFoundError:
             pass
 
-    app = web.Application()
-    app.add_routes(routes)
-    app["user_data"] = base64.b64decode(instance.user_data or "")
-    app["meta_data"] = meta_data
-    app["hw_addr"] = instance._br_hwadd
+    network_data = {
+        "links": [
+            {
+                "id": "br_link0",
+                "ethernet_mac_address": instance._br_hwadd,
+                "type": "bridge",
+            }
+        ],
+        "networks": [
+            {
+                "id": "network0",
+                "link": "br_link0",
+                "type": "ipv4_dhcp",
+            }
+        ],
+        "services": [],
+    }
+    if port := instance._port:
+        network_data["networks"][0] = {
+            "id": "network0",
+            "link": "br_link0",
+            "type": "ipv4",
+            "ip_address": str(port.ip),
+            "netmask": str(port.subnet.network.netmask),
+            "routes": [
+                {
+                    "network": "0.0.0.0",
+                    "netmask": "0.0.0.0",
+                    "gateway": str(port.subnet.gateway),
+                }
+            ],
+            "network_id": port.network_id,
+        }
+        network_data["services"] = [
+            {"type": "dns", "address": address} for address in port.subnet.dns
+        ]
+    user_data = base64.b64decode(instance.user_data or "")
+    files = {
+        "/openstack/latest/meta_data.json": meta_data,
+        "/openstack/latest/network_data.json": network_data,
+        "/openstack/latest/vendor_data.json": {},
+        "/openstack/latest/vendor_data2.json": {},
+        "/openstack/latest/user_data": user_data,
+        "/latest/user-data": user_data,
+        "/latest/meta-data/instance-id": meta_data["uuid"],
+        "/latest/meta-data/hostname": meta_data["hostname"],
+        "/latest/meta-data/local-hostname": meta_data["hostname"],
+        "/latest/meta-data/placement/availability-zone": AZ_NAME,
+    }
+    for i, key in enumerate(meta_data["public_keys"].values()):
+        files[f"/latest/meta-data/public-keys/{i}/openssh-key"] = key
+    return files
 
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, host="127.0.0.1", port=0)
-    await site.start()
 
-    def cleanup():
-        asyncio.get_event_loop().is_running() and asyncio.create_task(site.stop())
+def drive_files(files: Dict[str, object]) -> Dict[str, bytes]:
+    """What goes on a config drive, out of the metadata files."""
+    return {
+        path[1:]: _encode(content)[0]
+        for path, content in files.items()
+        if path.startswith("/openstack/")
+    }
+
+
+@routes.get("/{path:.*}")
+async def serve(request: web.Request) -> web.Response:
+    try:
+        doc = _instance(request)[_canonical(request.path)]
+    except KeyError:
+        raise web.HTTPNotFound()
+    if any(tag.value in (doc.etag, "*") for tag in request.if_none_match or ()):
+        response = web.Response(status=304)
+    else:
+        response = web.Response(body=doc.body, content_type=doc.content_type)
+    response.etag = doc.etag
+    return response
 
-    return (
-        cleanup,
-        site._server.sockets[0].getsockname()[1],
+
+async def _get_runner() -> web.AppRunner:
+    global _runner
+    if _runner is None:
+        app = web.Application()
+        app.add_routes(routes)
+        runner = web.AppRunner(app, keepalive_timeout=KEEPALIVE_TIMEOUT)
+        await runner.setup()
+        _runner = runner
+    return _runner
+
+
+async def mk_metadata(files: Dict[str, object], sock: Path) -> Callable:
+    """serve metadata files on a unix socket. returns a closer."""
+    path = str(sock.absolute())
+    _instances[path] = _render(files)
+    runner = await _get_runner()
+    server = await asyncio.get_running_loop().create_unix_server(
+        lambda: _Stream(runner.server), path
     )
+
+    def cleanup():
+        _instances.pop(path, None)
+        server.close()
+
+    return cleanup
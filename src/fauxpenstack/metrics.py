@@ -0,0 +1,240 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Prometheus metrics, without pulling in a client library for it."""
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1) -> None:
+        self.value += amount
+
+    def dec(self, amount=1) -> None:
+        self.value -= amount
+
+    def set(self, value) -> None:
+        self.value = value
+
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children: Dict[Tuple, object] = {}
+        REGISTRY.append(self)
+
+    def labels(self, *values):
+        """Get the child for a set of label values, keep it around if hot."""
+        try:
+            return self._children[values]
+        except KeyError:
+            child = self._children[values] = self._new_child()
+            return child
+
+    def _new_child(self):
+        return _Value()
+
+    def _samples(self) -> Iterator[Tuple[str, str, object]]:
+        for values, child in self._children.items():
+            yield "", _labels(self.label_names, values), child.value
+
+    def render(self, extra: Sequence[str] = ()) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for suffix, labels, value in self._samples():
+            lines.append(f"{self.name}{suffix}{labels} {value}")
+        lines.extend(extra)
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        function: Optional[Callable[[], Dict[Tuple, float]]] = None,
+    ):
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def _samples(self) -> Iterator[Tuple[str, str, object]]:
+        if self.function:
+            for values, value in self.function().items():
+                yield "", _labels(self.label_names, values), value
+        else:
+            yield from super()._samples()
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _Buckets(self.buckets)
+
+    def _samples(self) -> Iterator[Tuple[str, str, object]]:
+        for values, child in self._children.items():
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), child.counts):
+                total += count
+                le = _labels(self.label_names, values, f'le="{bound}"')
+                yield "_bucket", le, total
+            labels = _labels(self.label_names, values)
+            yield "_sum", labels, child.sum
+            yield "_count", labels, total
+
+
+REQUESTS = Counter(
+    "fauxpenstack_http_requests_total",
+    "HTTP requests served.",
+    ("app", "route", "method", "status"),
+)
+IN_FLIGHT = Gauge(
+    "fauxpenstack_http_requests_in_flight", "HTTP requests being served.", ("app",)
+)
+LATENCY = Histogram(
+    "fauxpenstack_http_request_duration_seconds",
+    "Time spent serving HTTP requests.",
+    ("app", "route"),
+)
+TRANSFER = Counter(
+    "fauxpenstack_transfer_bytes_total",
+    "Object and image data moved.",
+    ("service", "direction"),
+)
+QEMU_SPAWN = Histogram(
+    "fauxpenstack_qemu_spawn_seconds", "Time spent starting qemu processes."
+)
+QEMU_IMG = Histogram(
+    "fauxpenstack_qemu_img_seconds", "Time spent running qemu-img.", ("op",)
+)
+INSTANCES = Gauge("fauxpenstack_instances", "Instances by status.", ("status",))
+
+
+@web.middleware
+async def middleware(request: web.Request, handler: Callable) -> web.StreamResponse:
+    match_info = request.match_info
+    app = match_info.apps[-1].get("ep_type", "root") if match_info.apps else "root"
+    resource = match_info.route.resource
+    route = resource.canonical if resource else "unmatched"
+    in_flight = IN_FLIGHT.labels(app)
+    in_flight.inc()
+    start = time.monotonic()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        in_flight.dec()
+        LATENCY.labels(app, route).observe(time.monotonic() - start)
+        REQUESTS.labels(app, route, request.method, status).inc()
+
+
+def parse(text: str) -> Dict[str, List[str]]:
+    """Sample lines of another process's exposition, by metric name."""
+    samples: Dict[str, List[str]] = {}
+    lines: List[str] = []
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            lines = samples.setdefault(line.split()[2], [])
+        elif line and not line.startswith("#"):
+            lines.append(line)
+    return samples
+
+
+def response(remote: str = "") -> web.Response:
+    """Our registry, with the samples of remote merged in.
+
+    Processes count different things, so series don't overlap.
+    """
+    extra = parse(remote)
+    text = "\n".join(m.render(extra.get(m.name, ())) for m in REGISTRY) + "\n"
+    return web.Response(
+        body=text.encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def handler(request: web.Request) -> web.Response:
+    return response()
@@ -11,62 +11,235 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import functools
 import logging
+import math
 import re
 import time
-from typing import Callable
+from collections import OrderedDict
+from typing import Callable, Dict, FrozenSet, List, Optional, Set, Tuple
 
 from aiohttp import web
 
 from . import glue
 
 
+# paths with no regex syntax, save for a trailing *
+_PLAIN = re.compile(r"(/[\w/:-]*)?\**")
+
+
 @web.middleware
 def idler(request, handler) -> web.Response:
     request.config_dict["last_request"][0] = time.time()
     return handler(request)
 
 
-def acl_middleware(app_config) -> Callable:
+class AclTable:
+    """ACLs compiled to a single regex per (role, permission).
+
+    Patterns keep their original meaning: a match at the start of the path
+    with * as a wildcard. Decisions get memoized, by as much of the path as
+    the patterns look at, so objects and servers don't each get their own.
+    """
+
+    ANONYMOUS = "ANONYMOUS"
+
+    def __init__(self, app_config, cache_size: int = 4096):
+        grants: Dict[Tuple[str, str], List[str]] = {}
+        for pattern, rule in app_config["acls"].items():
+            for role, perms in rule.items():
+                for perm in perms:
+                    grants.setdefault((role, perm), []).append(pattern)
+        self._rules = {
+            grant: re.compile("|".join(f"(?:{p.replace('*', '.*')})" for p in pats))
+            for grant, pats in grants.items()
+        }
+
+        roles: Dict[str, Set[str]] = {}
+        for role, users in app_config["roles"].items():
+            for user in users:
+                roles.setdefault(user, {self.ANONYMOUS}).add(role)
+        self._user_roles = {user: frozenset(r) for user, r in roles.items()}
+        self.anonymous = frozenset([self.ANONYMOUS])
+
+        # how far into paths patterns look, by first segment
+        self._depths: Optional[Dict[str, int]] = {}
+        for pattern in app_config["acls"]:
+            if not _PLAIN.fullmatch(pattern):
+                self._depths = None  # anywhere, keep whole paths
+                break
+            prefix = pattern.rstrip("*")
+            first, slash, _ = prefix[1:].partition("/")
+            if slash:
+                self._depths[first] = max(self._depths.get(first, 0), len(prefix))
+        self._decide = functools.lru_cache(maxsize=cache_size)(self._allows)
+        self.cache_clear = self._decide.cache_clear
+
+    def roles(self, user: str) -> FrozenSet[str]:
+        return self._user_roles.get(user, self.anonymous)
+
+    def allows(self, path: str, perm: str, roles: FrozenSet[str]) -> bool:
+        depths = self._depths
+        if depths is not None:
+            first = path[1:].partition("/")[0]
+            path = path[: depths.get(first) or len(first) + 2]
+        return self._decide(path, perm, roles)
+
+    def _allows(self, path: str, perm: str, roles: FrozenSet[str]) -> bool:
+        for role in roles:
+            rule = self._rules.get((role, perm))
+            if rule and rule.match(path):
+                return True
+        return False
+
+
+@web.middleware
+def snapshot_config(request, handler) -> web.Response:
+    """Pin the current config for the whole request, reloads notwithstanding."""
+    request["app_config"] = request.config_dict["config"][0]
+    return handler(request)
+
+
+def acl_middleware() -> Callable:
     """basic authorization scheme"""
 
     @web.middleware
     async def _wrapper(request: web.Request, handler: Callable) -> web.Response:
         perm = request.method.lower()
+        acl = request["app_config"].acl
+        start = time.perf_counter()
         try:
             token = request.headers["X-Auth-Token"]
-            key = request.config_dict["app_config"]["secret_key"]
+            key = request["app_config"]["secret_key"]
             try:
-                user = glue.decode_token(key, token)["user"]["name"]
+                user, _, _ = glue.authenticate(key, token)
             except glue.InvalidTokenError:
                 logging.error("token validation error")
                 return web.Response(status=401)
-            roles = set(k for k, v in app_config["roles"].items() if user in v)
+            roles = acl.roles(user)
         except KeyError:
-            token = "NO_TOKEN"
-            roles = set()
-        roles.add("ANONYMOUS")
+            user = None
+            roles = acl.anonymous
+        request["user"] = user
 
-        for pattern, rule in app_config["acls"].items():
-            if re.match(pattern.replace("*", ".*"), request.path):
-                for role in roles:
-                    try:
-                        if perm in rule[role]:
-                            return await handler(request)
-                    except KeyError:
-                        continue
-        else:
-            logging.warning(
-                "rejected access with perm %r , path %r and roles %r",
-                perm,
-                request.path,
-                roles,
-            )
-            return web.Response(status=401)
+        authenticated = time.perf_counter()
+        allowed = acl.allows(request.path, perm, roles)
+        request["timings"] = (
+            authenticated - start,
+            time.perf_counter() - authenticated,
+        )
+        if allowed:
+            return await handler(request)
+        logging.warning(
+            "rejected access with perm %r , path %r and roles %r",
+            perm,
+            request.path,
+            set(roles),
+        )
+        return web.Response(status=401)
 
     return _wrapper
 
 
+class Limiter:
+    """Per user request rate and heavy operation concurrency limits.
+
+    Rates are token buckets, refilled lazily when a user shows up again.
+    Only the most recently seen users are tracked.
+    """
+
+    # uploads, downloads and boots
+    HEAVY = {
+        ("PUT", "/objects/{bucket}/{path}"),
+        ("GET", "/objects/{bucket}/{path}"),
+        ("PUT", "/images/v2/images/{uuid}/file"),
+        ("POST", "/compute/servers"),
+    }
+
+    def __init__(self, max_users: int = 4096):
+        self.rate = 0.0
+        self.burst = 0.0
+        self.heavy = 0
+        self.max_users = max_users
+        self._buckets: OrderedDict = OrderedDict()  # user -> [tokens, last refill]
+        self._heavy: Dict[str, int] = {}
+
+    @staticmethod
+    def settings(config: dict) -> Tuple[float, float, int]:
+        """rate, burst and heavy out of [limits], ValueError if unusable.
+
+        A bucket holding less than a token would refuse every request.
+        """
+        rate = float(config.get("rate", 0))
+        burst = float(config.get("burst", max(rate, 1.0)))
+        if rate and burst < 1:
+            raise ValueError(f"limits burst must be at least 1, not {burst}")
+        return rate, burst, int(config.get("heavy", 0))
+
+    def configure(self, config: dict) -> None:
+        self.rate, self.burst, self.heavy = self.settings(config)
+        self._buckets.clear()
+
+    def take(self, user: str) -> float:
+        """Use up a request, returns how long to wait if there is none left."""
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        try:
+            bucket = self._buckets[user]
+            self._buckets.move_to_end(user)
+        except KeyError:
+            bucket = self._buckets[user] = [self.burst, now]
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return (1 - tokens) / self.rate
+        bucket[0] = tokens - 1
+        return 0
+
+    def is_heavy(self, request: web.Request) -> bool:
+        resource = request.match_info.route.resource
+        if resource is None:
+            return False
+        return (request.method, resource.canonical) in self.HEAVY
+
+    def acquire(self, user: str) -> bool:
+        """Account for a heavy operation, False if the user has too many."""
+        running = self._heavy.get(user, 0)
+        if running >= self.heavy:
+            return False
+        self._heavy[user] = running + 1
+        return True
+
+    def release(self, user: str) -> None:
+        if running := self._heavy[user] - 1:
+            self._heavy[user] = running
+        else:
+            del self._heavy[user]
+
+
+limiter = Limiter()
+
+
+@web.middleware
+async def limit_middleware(request: web.Request, handler: Callable) -> web.Response:
+    """Throttle users, see Limiter."""
+    user = request.get("user") or request.remote or ""
+    if wait := limiter.take(user):
+        return web.Response(status=429, headers={"Retry-After": str(math.ceil(wait))})
+    if not limiter.heavy or not limiter.is_heavy(request):
+        return await handler(request)
+    if not limiter.acquire(user):
+        return web.Response(status=429, headers={"Retry-After": "1"})
+    try:
+        return await handler(request)
+    finally:
+        limiter.release(user)
+
+
 @web.middleware
 def no_rel(request, handler) -> web.Response:
     """Deny path traversal."""
@@ -13,6 +13,10 @@
 # limitations under the License.
 """neutrino n. a neutral particle lighter than a neutron"""
 
+import ipaddress
+from typing import Dict, Iterable, Optional, Tuple
+from uuid import uuid4
+
 from aiohttp import web
 
 from . import util
@@ -24,13 +28,139 @@ app["ep_type"] = "network"
 util.make_endpoint(routes, "2.0", "v2.0")
 
 
+class AddressesExhausted(Exception):
+    pass
+
+
+class Subnet:
+    """Static addresses of a network, handed out from a bitmap.
+
+    Networks without one are left to whatever serves dhcp on the bridge.
+    """
+
+    def __init__(
+        self,
+        network_id: str,
+        cidr: str,
+        gateway: Optional[str] = None,
+        dns: Iterable[str] = (),
+        pool: Optional[Tuple[str, str]] = None,
+    ):
+        self.network_id = network_id
+        self.network = ipaddress.IPv4Network(cidr)
+        hosts = (self.network.network_address + 1, self.network.broadcast_address - 1)
+        start, end = [ipaddress.IPv4Address(a) for a in pool] if pool else hosts
+        if not (hosts[0] <= start <= end <= hosts[1]):
+            raise ValueError(f"bad address pool for {network_id}")
+        self.gateway = ipaddress.IPv4Address(gateway) if gateway else hosts[0]
+        self.dns = [str(ipaddress.IPv4Address(a)) for a in dns]
+        self.start, self.end = start, end
+        self._first = int(start)
+        self._size = int(end) - int(start) + 1
+        self._used = 0  # bit n set when start + n is taken
+        self.take(self.gateway)
+
+    def allocate(self) -> ipaddress.IPv4Address:
+        free = ~self._used & (self._used + 1)  # lowest unset bit
+        index = free.bit_length() - 1
+        if index >= self._size:
+            raise AddressesExhausted(self.network_id)
+        self._used |= free
+        return ipaddress.IPv4Address(self._first + index)
+
+    def take(self, address: ipaddress.IPv4Address) -> None:
+        if 0 <= (index := int(address) - self._first) < self._size:
+            self._used |= 1 << index
+
+    def release(self, address: ipaddress.IPv4Address) -> None:
+        if 0 <= (index := int(address) - self._first) < self._size:
+            self._used &= ~(1 << index)
+
+    def info(self) -> dict:
+        return {
+            "id": self.network_id,
+            "name": self.network_id,
+            "network_id": self.network_id,
+            "ip_version": 4,
+            "cidr": str(self.network),
+            "gateway_ip": str(self.gateway),
+            "dns_nameservers": self.dns,
+            "allocation_pools": [{"start": str(self.start), "end": str(self.end)}],
+            "enable_dhcp": False,
+        }
+
+
+class Port:
+    def __init__(
+        self, subnet: Subnet, mac: str, ip: ipaddress.IPv4Address, device_id: str
+    ):
+        self.id = str(uuid4())
+        self.subnet = subnet
+        self.network_id = subnet.network_id
+        self.mac = mac
+        self.ip = ip
+        self.device_id = device_id
+
+    def info(self) -> dict:
+        return {
+            "id": self.id,
+            "name": "",
+            "network_id": self.network_id,
+            "mac_address": self.mac,
+            "fixed_ips": [{"subnet_id": self.network_id, "ip_address": str(self.ip)}],
+            "device_id": self.device_id,
+            "device_owner": "compute:nova",
+            "status": "ACTIVE",
+            "admin_state_up": True,
+        }
+
+
+class Ipam:
+    """Subnets from conf.toml, and the ports allocated in them."""
+
+    def __init__(self):
+        self.subnets: Dict[str, Subnet] = {}
+        self.ports: Dict[str, Port] = {}
+
+    def configure(self, config: dict) -> None:
+        subnets = {name: Subnet(name, **spec) for name, spec in config.items()}
+        # ports keep their address, even if it is no longer in the subnet
+        for port in self.ports.values():
+            if subnet := subnets.get(port.network_id):
+                subnet.take(port.ip)
+                port.subnet = subnet
+        self.subnets = subnets
+
+    def allocate(self, network_id: str, mac: str, device_id: str) -> Optional[Port]:
+        """Get a port with a static address, if the network has a subnet."""
+        if not (subnet := self.subnets.get(network_id)):
+            return None
+        port = Port(subnet, mac, subnet.allocate(), device_id)
+        self.ports[port.id] = port
+        return port
+
+    def release(self, port: Port) -> None:
+        self.ports.pop(port.id, None)
+        if subnet := self.subnets.get(port.network_id):
+            subnet.release(port.ip)
+
+
+ipam = Ipam()
+
+
 @routes.get("/v2.0/networks")
 async def listing(request: web.Request) -> web.Response:
-    nets = request.config_dict["app_config"]["net_bridges"]
-    return web.json_response(
+    nets = request["app_config"]["net_bridges"]
+    return util.json_response(
         {
             "networks": [
-                {"name": name, "id": name, "label": name, "status": "ACTIVE"}
+                {
+                    "name": name,
+                    "id": name,
+                    "label": name,
+                    "status": "ACTIVE",
+                    "subnets": [name] if name in ipam.subnets else [],
+                }
                 for name in nets.keys()
             ]
         }
@@ -40,38 +170,70 @@ async def listing(request: web.Request) -> web.Response:
 @routes.get("/v2.0/networks/{network_id}")
 async def get_network(request: web.Request) -> web.Response:
     network_id = request.match_info["network_id"]
-    try:
-        return web.json_response(
-            {
-                "network": {
-                    "name": network_id,
-                    "id": network_id,
-                    "status": "ACTIVE",
-                }
-            }
-        )
-    except KeyError:
+    if network_id not in request["app_config"]["net_bridges"]:
         return web.Response(status=404)
+    return util.json_response(
+        {
+            "network": {
+                "name": network_id,
+                "id": network_id,
+                "status": "ACTIVE",
+                "subnets": [network_id] if network_id in ipam.subnets else [],
+            }
+        }
+    )
 
 
 @routes.get("/v2.0/subnets")
 async def list_subnets(request: web.Request) -> web.Response:
-    return web.json_response({"subnets": []})
+    return util.json_response(
+        {"subnets": [subnet.info() for subnet in ipam.subnets.values()]}
+    )
+
+
+@routes.get("/v2.0/subnets/{subnet_id}")
+async def get_subnet(request: web.Request) -> web.Response:
+    try:
+        subnet = ipam.subnets[request.match_info["subnet_id"]]
+    except KeyError:
+        return web.Response(status=404)
+    return util.json_response({"subnet": subnet.info()})
 
 
 @routes.get("/v2.0/floatingips")
 async def list_floatingips(request: web.Request) -> web.Response:
-    return web.json_response({"floatingips": []})
+    return util.json_response({"floatingips": []})
 
 
 @routes.get("/v2.0/ports")
 async def list_ports(request: web.Request) -> web.Response:
-    return web.json_response({"ports": []})
+    filters = {
+        k: request.query[k]
+        for k in ("device_id", "network_id", "mac_address")
+        if k in request.query
+    }
+    ports = (port.info() for port in ipam.ports.values())
+    return util.json_response(
+        {
+            "ports": [
+                port for port in ports if all(port[k] == v for k, v in filters.items())
+            ]
+        }
+    )
+
+
+@routes.get("/v2.0/ports/{port_id}")
+async def get_port(request: web.Request) -> web.Response:
+    try:
+        port = ipam.ports[request.match_info["port_id"]]
+    except KeyError:
+        return web.Response(status=404)
+    return util.json_response({"port": port.info()})
 
 
 @routes.get("/v2.0/security-groups")
 async def security_groups(request: web.Request) -> web.Response:
-    return web.json_response(
+    return util.json_response(
         dict(
             security_groups=[
                 dict(
@@ -88,7 +250,7 @@ async def security_groups(request: web.Request) -> web.Response:
 
 @routes.post("/v2.0/security-group-rules")
 async def add_security_group_rules(request: web.Request) -> web.Response:
-    return web.json_response(status=201)
+    return util.json_response(status=201)
 
 
 app.add_routes(routes)
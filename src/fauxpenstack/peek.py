@@ -15,13 +15,14 @@
 
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Optional
+from typing import AsyncIterator, Optional, Tuple
 from uuid import uuid4
 
 import aiofiles.os
 from aiohttp import web
 
-from .util import make_endpoint
+from . import fs, metrics
+from .util import json_response, json_stream, make_endpoint
 
 IMAGES = Path("images")
 
@@ -31,13 +32,60 @@ app["ep_type"] = "image"
 app["ep_name"] = __name__
 make_endpoint(routes, "2", "v2")
 
+# called with the path of images which get replaced or deleted
+image_listeners = []
+
+_bytes_in = metrics.TRANSFER.labels("peek", "in")
+
+
+def _saving(entries) -> set:
+    """ids of images still being written by a background job"""
+    return {e[1:-7] for e in entries if e.startswith(".") and e.endswith(".saving")}
+
 
 async def get_image_by_id(image_id):
-    for image in await aiofiles.os.listdir(IMAGES):
+    entries = await aiofiles.os.listdir(IMAGES)
+    if image_id in _saving(entries):
+        return None
+    for image in entries:
         if image.startswith(image_id + ":"):
             return IMAGES / image
 
 
+async def reserve_image(
+    name: str, arch: str, format: str = "qcow2"
+) -> Tuple[str, Path]:
+    """Allocate an image which is reported as saving until image_saved.
+
+    It is listed right away, as an empty file to be overwritten.
+    """
+    uuid = str(uuid4())
+    name = name.replace("/", "_")
+    marker = IMAGES / f".{uuid}.saving"
+    path = IMAGES / f"{uuid}:{name}.{arch}.{format}"
+    async with aiofiles.open(marker, "wb"):
+        pass
+    try:
+        async with aiofiles.open(path, "wb"):
+            pass
+    except BaseException:
+        await aiofiles.os.remove(marker)
+        raise
+    return uuid, path
+
+
+async def image_saved(uuid: str, ok: bool = True) -> None:
+    """Mark a reserved image active, or drop it if saving failed."""
+    try:
+        await aiofiles.os.remove(IMAGES / f".{uuid}.saving")
+    except FileNotFoundError:
+        ok = False  # deleted while saving
+    if not ok:
+        for image in await aiofiles.os.listdir(IMAGES):
+            if image.startswith(uuid + ":"):
+                await aiofiles.os.remove(IMAGES / image)
+
+
 @routes.post("/v2/images")
 async def create_image(request: web.Request) -> web.Response:
     payload = await request.json()
@@ -54,7 +102,7 @@ async def create_image(request: web.Request) -> web.Response:
         pass  # touch
 
     ts = datetime.now(timezone.utc).isoformat("T", "seconds")
-    return web.json_response(
+    return json_response(
         {
             "status": "active",
             "name": name,
@@ -90,19 +138,27 @@ async def upload(request: web.Request) -> web.Response:
     else:
         return web.Response(status=404)
     path = IMAGES / image
+    for listener in image_listeners:
+        listener(path)
     async with aiofiles.open(path, "wb") as f:
         body = request.content
         async for chunk in body.iter_any():
             await f.write(chunk)
+            _bytes_in.inc(len(chunk))
     return web.Response(status=204)
 
 
 @routes.get("/v2/images")
-async def list(request: web.Request) -> web.Response:
+async def list(request: web.Request) -> web.StreamResponse:
     limit = int(request.query.get("limit", 0))
     marker = request.query.get("marker")
     end_marker = request.query.get("end_marker")
-    return web.json_response(await _list(limit, marker, end_marker))
+    return await json_stream(
+        request,
+        _images(limit, marker, end_marker),
+        b'{"images": [',
+        b'], "schema": "/v2/schemas/images", "first": "/v2/images"}',
+    )
 
 
 async def _list(
@@ -110,45 +166,56 @@ async def _list(
     marker: Optional[str] = None,
     end_marker: Optional[str] = None,
 ):
-    listing = []
-    for image in await aiofiles.os.listdir(IMAGES):
-        if (end_marker and image > end_marker) or (limit and len(listing) > limit):
+    images = [image async for image in _images(limit, marker, end_marker)]
+    return {"images": images, "schema": "/v2/schemas/images", "first": "/v2/images"}
+
+
+async def _images(
+    limit: Optional[int] = None,
+    marker: Optional[str] = None,
+    end_marker: Optional[str] = None,
+) -> AsyncIterator[dict]:
+    entries = [entry.name async for entry in fs.scandir(IMAGES)]
+    saving = _saving(entries)
+    images = []
+    for image in entries:
+        if (end_marker and image > end_marker) or (limit and len(images) > limit):
             break
         if marker and image <= marker:
             continue
-        uuid, sep, name = image.partition(":")
-        if not sep:
-            continue
+        if ":" in image:
+            images.append(image)
+    stats = fs.stats(IMAGES / image for image in images)
+    for image in images:
+        if (stat := await anext(stats)) is None:
+            continue  # deleted meanwhile
+        uuid, _, name = image.partition(":")
         name, _, format = name.rpartition(".")
         name, _, arch = name.rpartition(".")
-        stat = await aiofiles.os.stat(IMAGES / image)
-        listing.append(
-            {
-                "status": "active",
-                "name": name,
-                "architecture": arch,
-                "tags": [],
-                "container_format": "bare",
-                "disk_format": format,
-                "visibility": "public",
-                "min_disk": 0,
-                "min_ram": 0,
-                "virtual_size": None,
-                "protected": False,
-                "id": uuid,
-                "self": f"/v2/images/{uuid}",
-                "file": f"/v2/images/{uuid}/file",
-                "checksum": None,
-                "os_hash_algo": "sha512",
-                "os_hash_value": "FIXME",
-                "os_hidden": False,
-                "created_at": "FIXME",
-                "updated_at": "FIXME",
-                "size": stat.st_size,
-                "schema": "/v2/schemas/image",
-            }
-        )
-    return {"images": listing, "schema": "/v2/schemas/images", "first": "/v2/images"}
+        yield {
+            "status": "saving" if uuid in saving else "active",
+            "name": name,
+            "architecture": arch,
+            "tags": [],
+            "container_format": "bare",
+            "disk_format": format,
+            "visibility": "public",
+            "min_disk": 0,
+            "min_ram": 0,
+            "virtual_size": None,
+            "protected": False,
+            "id": uuid,
+            "self": f"/v2/images/{uuid}",
+            "file": f"/v2/images/{uuid}/file",
+            "checksum": None,
+            "os_hash_algo": "sha512",
+            "os_hash_value": "FIXME",
+            "os_hidden": False,
+            "created_at": "FIXME",
+            "updated_at": "FIXME",
+            "size": stat.st_size,
+            "schema": "/v2/schemas/image",
+        }
 
 
 @routes.get("/v2/images/{uuid}")
@@ -157,7 +224,7 @@ async def get_image(request: web.Request) -> web.Response:
     listing = await _list(1, uuid)
     if not listing["images"]:
         return web.Response(status=404)
-    return web.json_response(listing["images"][0])
+    return json_response(listing["images"][0])
 
 
 @routes.delete("/v2/images/{image_id}")
@@ -166,6 +233,12 @@ async def delete(request: web.Request) -> web.Response:
     for image in await aiofiles.os.listdir(IMAGES):
         if image.startswith(uuid + ":"):
             await aiofiles.os.remove(IMAGES / image)
+            for listener in image_listeners:
+                listener(IMAGES / image)
+            try:
+                await aiofiles.os.remove(IMAGES / f".{uuid}.saving")
+            except FileNotFoundError:
+                pass
             return web.Response(status=204)
 
     return web.Response(status=404)
@@ -174,7 +247,7 @@ async def delete(request: web.Request) -> web.Response:
 @routes.get("/v2/schemas/image")
 async def schema(request: web.Request) -> web.Response:
     # just enough to make glanceclient satisfied
-    return web.json_response(
+    return json_response(
         {
             "name": "images",
             "properties": {},
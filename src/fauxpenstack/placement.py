@@ -0,0 +1,131 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Host cores, by NUMA node, and who gets to run on them.
+
+Reserved cores run the service itself. Instances with dedicated cores get
+them all to themselves on a single node, the other ones share the rest.
+"""
+import logging
+import os
+from pathlib import Path
+from typing import Dict, FrozenSet, NamedTuple, Set
+
+NODES = Path("/sys/devices/system/node")
+
+
+class CoresExhausted(Exception):
+    pass
+
+
+class Pinning(NamedTuple):
+    node: int
+    cores: FrozenSet[int]
+
+
+def parse_cpulist(text: str) -> Set[int]:
+    """Cores of a cpulist, as in sysfs or taskset: 0-3,8"""
+    cores = set()
+    for part in filter(None, text.strip().split(",")):
+        first, _, last = part.partition("-")
+        cores.update(range(int(first), int(last or first) + 1))
+    return cores
+
+
+def topology(usable: Set[int]) -> Dict[int, Set[int]]:
+    """Usable cores by NUMA node, a single node if sysfs doesn't say."""
+    nodes = {}
+    for node in NODES.glob("node[0-9]*"):
+        try:
+            cores = parse_cpulist((node / "cpulist").read_text()) & usable
+        except OSError:
+            continue
+        if cores:
+            nodes[int(node.name[4:])] = cores
+    return nodes or {0: set(usable)}
+
+
+def set_affinity(pid: int, cores: Set[int]) -> None:
+    """Move every thread of a process to cores.
+
+    The main thread goes first, threads started after that inherit it and
+    those started before are in the task list.
+    """
+    try:
+        os.sched_setaffinity(pid, cores)
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return  # gone already
+    for tid in tasks:
+        try:
+            os.sched_setaffinity(int(tid), cores)
+        except OSError:
+            pass
+
+
+class Placement:
+    """Cores of this host, reserved ones from conf.toml."""
+
+    def __init__(self):
+        # what we may run on, before pinning ourselves anywhere
+        self.host = os.sched_getaffinity(0)
+        self.nodes = topology(self.host)
+        self.reserved: Set[int] = set()
+        self.dedicated: Dict[str, Pinning] = {}
+        self.shared: Dict[str, int] = {}  # owner -> pid
+
+    def configure(self, config: dict) -> None:
+        self.reserved = parse_cpulist(config.get("reserved_cpus", "")) & self.host
+        set_affinity(os.getpid(), self.reserved or self.host)
+        self._repin()
+
+    def shared_cores(self) -> Set[int]:
+        """What instances without dedicated cores run on."""
+        taken = set().union(*(p.cores for p in self.dedicated.values()))
+        return (
+            self.host - self.reserved - taken or self.host - self.reserved or self.host
+        )
+
+    def dedicate(self, owner: str, count: int) -> Pinning:
+        """count cores of a single node, the one they fit best."""
+        taken = set().union(*(p.cores for p in self.dedicated.values()))
+        free = {
+            node: sorted(cores - self.reserved - taken)
+            for node, cores in self.nodes.items()
+        }
+        fits = [node for node, cores in free.items() if len(cores) >= count]
+        if not fits:
+            raise CoresExhausted(f"no node has {count} free cores")
+        node = min(fits, key=lambda node: len(free[node]))
+        pinning = self.dedicated[owner] = Pinning(node, frozenset(free[node][:count]))
+        self._repin()
+        return pinning
+
+    def share(self, owner: str, pid: int) -> None:
+        """Keep a process on the shared cores, as they change."""
+        self.shared[owner] = pid
+        set_affinity(pid, self.shared_cores())
+
+    def release(self, owner: str) -> None:
+        self.shared.pop(owner, None)
+        if self.dedicated.pop(owner, None):
+            self._repin()
+
+    def _repin(self) -> None:
+        cores = self.shared_cores()
+        for pid in self.shared.values():
+            set_affinity(pid, cores)
+        logging.debug("shared cores: %s", sorted(cores))
+
+
+cpus = Placement()
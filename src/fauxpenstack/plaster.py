@@ -14,14 +14,27 @@
 """plaster n. building material used for decoration and coating"""
 
 import asyncio
+import json
+import logging
+import os
+import shutil
+from collections import OrderedDict
+from datetime import datetime, timezone
 from pathlib import Path
+from typing import Optional
 from uuid import uuid4
 
+import aiofiles.os
 from aiohttp import web
 
-from .util import make_endpoint
+from . import metrics, peek, qcow2
+from .peek import get_image_by_id
+from .util import json_response, make_endpoint
 
 VOLUMES = Path("volumes")
+SNAPSHOTS = VOLUMES / "snapshots"
+POOL = VOLUMES / "pool"
+AZ_NAME = "nova"
 
 routes = web.RouteTableDef()
 app = web.Application()
@@ -32,29 +45,483 @@ make_endpoint(routes, "3.0")
 
 async def make_volume_from_image(instance_id, image_path, size) -> Path:
     volume = VOLUMES / str(uuid4())
-    back_format = str(image_path).rpartition(".")[2]
-    proc = await asyncio.create_subprocess_exec(
-        "qemu-img",
-        "create",
-        "-f",
-        "qcow2",
-        "-b",
-        image_path.absolute(),
-        "-F",
-        back_format,
-        volume.absolute(),
-        f"{size}M",
-    )
-    await proc.wait()
-    if proc.returncode != 0:
-        raise RuntimeError(proc.stderr)
+    if not pool.take(image_path, size, volume):
+        await create_overlay(volume, image_path, size)
     return volume
 
 
+async def create_overlay(volume: Path, image_path: Path, size: int) -> None:
+    back_format = str(image_path).rpartition(".")[2]
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            qcow2.create,
+            volume,
+            size * 2**20,
+            image_path.absolute(),
+            back_format,
+        )
+        return
+    except (OSError, ValueError):
+        logging.exception("native overlay creation failed, trying qemu-img")
+        volume.unlink(missing_ok=True)
+
+    with metrics.QEMU_IMG.labels("create").time():
+        proc = await asyncio.create_subprocess_exec(
+            "qemu-img",
+            "create",
+            "-f",
+            "qcow2",
+            "-b",
+            image_path.absolute(),
+            "-F",
+            back_format,
+            volume.absolute(),
+            f"{size}M",
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, err = await proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(err.decode(errors="replace"))
+
+
+def _identity(path: Path) -> tuple:
+    st = os.stat(path)
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+class OverlayPool:
+    """Ready made boot overlays for recently used (image, size) pairs.
+
+    Taking one is a rename, refills happen in the background.
+    """
+
+    def __init__(self, depth: int = 2, max_entries: int = 8):
+        self.depth = depth
+        self.max_entries = max_entries
+        # (image, size) -> [(overlay, image identity)], least recently used first
+        self._entries: OrderedDict = OrderedDict()
+        self._refills = set()
+
+    def configure(self, config: dict) -> None:
+        self.depth = config.get("depth", self.depth)
+        self.max_entries = config.get("max_entries", self.max_entries)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    def take(self, image_path: Path, size: int, dest: Path) -> bool:
+        """Move a pooled overlay to dest, returns False on a miss."""
+        if not self.depth:
+            return False
+        key = (image_path.absolute(), size)
+        try:
+            identity = _identity(image_path)
+        except OSError:
+            self._drop(key)
+            return False
+        overlays = self._entries.setdefault(key, [])
+        self._entries.move_to_end(key)
+        found = False
+        while overlays and not found:
+            overlay, overlay_identity = overlays.pop()
+            if overlay_identity == identity:
+                os.rename(overlay, dest)
+                found = True
+            else:  # image was replaced under us
+                overlay.unlink(missing_ok=True)
+
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+        if key not in self._refills:
+            job = asyncio.create_task(self._refill(key))
+            self._refills.add(key)
+            job.add_done_callback(lambda _: self._refills.discard(key))
+        return found
+
+    async def _refill(self, key) -> None:
+        image_path, size = key
+        await aiofiles.os.makedirs(POOL, exist_ok=True)
+        try:
+            while True:
+                overlays = self._entries.get(key)
+                if overlays is None or len(overlays) >= self.depth:
+                    break
+                identity = _identity(image_path)
+                overlay = POOL / str(uuid4())
+                await create_overlay(overlay, image_path, size)
+                if self._entries.get(key) is overlays:
+                    overlays.append((overlay, identity))
+                else:  # evicted meanwhile
+                    overlay.unlink(missing_ok=True)
+        except Exception:
+            logging.exception("could not refill overlay pool for %s", image_path)
+
+    def _drop(self, key) -> None:
+        for overlay, _ in self._entries.pop(key, []):
+            overlay.unlink(missing_ok=True)
+
+    def evict(self, image_path: Path) -> None:
+        """Forget overlays of an image which got deleted or replaced."""
+        image_path = image_path.absolute()
+        for key in [k for k in self._entries if k[0] == image_path]:
+            self._drop(key)
+
+    def clear(self) -> None:
+        for key in list(self._entries):
+            self._drop(key)
+        shutil.rmtree(POOL, ignore_errors=True)
+
+
+pool = OverlayPool()
+peek.image_listeners.append(pool.evict)
+
+
+async def convert_image(src: Path, dst: Path, format: str = "qcow2") -> None:
+    """Flatten src, along with its backing chain, into a standalone image."""
+    with metrics.QEMU_IMG.labels("convert").time():
+        proc = await asyncio.create_subprocess_exec(
+            "qemu-img",
+            "convert",
+            "-U",
+            "-O",
+            format,
+            src.absolute(),
+            dst.absolute(),
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, err = await proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(err.decode(errors="replace"))
+
+
+async def resize_image(path: Path, size: int) -> None:
+    with metrics.QEMU_IMG.labels("resize").time():
+        proc = await asyncio.create_subprocess_exec(
+            "qemu-img",
+            "resize",
+            "-q",
+            path.absolute(),
+            f"{size}G",
+            stderr=asyncio.subprocess.PIPE,
+        )
+        _, err = await proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(err.decode(errors="replace"))
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat("T", "seconds")
+
+
+class Volume:
+    def __init__(
+        self,
+        id: str,
+        name: Optional[str] = None,
+        size: int = 1,
+        description: Optional[str] = None,
+        image_id: Optional[str] = None,
+        snapshot_id: Optional[str] = None,
+        status: str = "creating",
+        created_at: Optional[str] = None,
+        attachments: Optional[list] = None,
+        metadata: Optional[dict] = None,
+    ):
+        self.id = id
+        self.name = name
+        self.size = size
+        self.description = description
+        self.image_id = image_id
+        self.snapshot_id = snapshot_id
+        self.status = status
+        self.created_at = created_at or _now()
+        self.attachments = attachments or []
+        self.metadata = metadata or {}
+
+    @property
+    def path(self) -> Path:
+        return VOLUMES / self.id
+
+    def info(self) -> dict:
+        return {
+            **self.__dict__,
+            "availability_zone": AZ_NAME,
+            "bootable": str(bool(self.image_id)).lower(),
+            "volume_type": None,
+            "multiattach": False,
+            "encrypted": False,
+            "links": [],
+        }
+
+    async def save(self, status: Optional[str] = None) -> None:
+        if status:
+            self.status = status
+        async with aiofiles.open(VOLUMES / f"{self.id}.json", "w") as f:
+            await f.write(json.dumps(self.__dict__))
+
+    async def attached(self, server_id: str, device: str) -> None:
+        self.attachments = [
+            {
+                "id": self.id,
+                "attachment_id": self.id,
+                "volume_id": self.id,
+                "server_id": server_id,
+                "device": device,
+                "host_name": None,
+                "attached_at": _now(),
+            }
+        ]
+        await self.save("in-use")
+
+    async def detached(self) -> None:
+        self.attachments = []
+        await self.save("available")
+
+    async def delete(self) -> None:
+        self.path.unlink(missing_ok=True)
+        await aiofiles.os.remove(VOLUMES / f"{self.id}.json")
+
+
+class Snapshot:
+    def __init__(
+        self,
+        id: str,
+        volume_id: str,
+        size: int,
+        name: Optional[str] = None,
+        description: Optional[str] = None,
+        status: str = "creating",
+        created_at: Optional[str] = None,
+    ):
+        self.id = id
+        self.volume_id = volume_id
+        self.size = size
+        self.name = name
+        self.description = description
+        self.status = status
+        self.created_at = created_at or _now()
+
+    @property
+    def path(self) -> Path:
+        return SNAPSHOTS / self.id
+
+    def info(self) -> dict:
+        return {**self.__dict__, "metadata": {}}
+
+    async def save(self, status: Optional[str] = None) -> None:
+        if status:
+            self.status = status
+        async with aiofiles.open(SNAPSHOTS / f"{self.id}.json", "w") as f:
+            await f.write(json.dumps(self.__dict__))
+
+    async def delete(self) -> None:
+        self.path.unlink(missing_ok=True)
+        await aiofiles.os.remove(SNAPSHOTS / f"{self.id}.json")
+
+
+volumes = {}
+snapshots = {}
+
+# volume data is copied around by qemu-img, don't run too many at once
+MAX_JOBS = 4
+_slots = asyncio.Semaphore(MAX_JOBS)
+_jobs = set()
+
+
+def _background(obj, work) -> None:
+    """Run work for a volume or snapshot, settling its status when done."""
+
+    async def _run():
+        async with _slots:
+            try:
+                await work
+            except Exception:
+                logging.exception("provisioning of %s failed", obj.id)
+                await obj.save("error")
+            else:
+                await obj.save("available")
+
+    job = asyncio.create_task(_run())
+    _jobs.add(job)
+    job.add_done_callback(_jobs.discard)
+
+
+async def _provision(volume: Volume, source: Optional[Path]) -> None:
+    if source is None:
+        await asyncio.get_running_loop().run_in_executor(
+            None, qcow2.create, volume.path, volume.size * 2**30
+        )
+        return
+    await convert_image(source, volume.path)
+    await resize_image(volume.path, volume.size)
+
+
+async def _load(app: web.Application) -> None:
+    # whatever is in there was left over by a previous run
+    pool.clear()
+    await aiofiles.os.makedirs(SNAPSHOTS, exist_ok=True)
+    for store, cls, registry in (
+        (VOLUMES, Volume, volumes),
+        (SNAPSHOTS, Snapshot, snapshots),
+    ):
+        for entry in await aiofiles.os.listdir(store):
+            if not entry.endswith(".json"):
+                continue
+            async with aiofiles.open(store / entry) as f:
+                obj = cls(**json.loads(await f.read()))
+            if obj.status == "creating":
+                obj.status = "error"
+            if isinstance(obj, Volume) and obj.attachments:
+                # VMs don't survive us, neither do their attachments
+                obj.attachments = []
+                obj.status = "available"
+            registry[obj.id] = obj
+
+
+@routes.get("/volumes")
 @routes.get("/volumes/detail")
+@routes.get("/{project_id}/volumes")
 @routes.get("/{project_id}/volumes/detail")
 async def list_volumes(request: web.Request) -> web.Response:
-    return web.json_response({"volumes": []})
+    return json_response({"volumes": [v.info() for v in volumes.values()]})
+
+
+@routes.post("/volumes")
+@routes.post("/{project_id}/volumes")
+async def create_volume(request: web.Request) -> web.Response:
+    try:
+        data = (await request.json())["volume"]
+        size = int(data["size"])
+    except (KeyError, TypeError, ValueError):
+        return web.Response(status=400)
+
+    source = None
+    if image_id := data.get("imageRef"):
+        source = await get_image_by_id(image_id)
+        if not source:
+            return web.Response(status=404)
+    elif snapshot_id := data.get("snapshot_id"):
+        try:
+            snapshot = snapshots[snapshot_id]
+        except KeyError:
+            return web.Response(status=404)
+        if snapshot.status != "available":
+            return web.Response(status=409)
+        source = snapshot.path
+
+    uuid = str(uuid4())
+    volume = volumes[uuid] = Volume(
+        uuid,
+        name=data.get("name"),
+        size=size,
+        description=data.get("description"),
+        image_id=image_id,
+        snapshot_id=data.get("snapshot_id"),
+        metadata=data.get("metadata"),
+    )
+    await volume.save()
+    _background(volume, _provision(volume, source))
+    return json_response({"volume": volume.info()}, status=202)
+
+
+@routes.get("/volumes/{volume_id}")
+@routes.get("/{project_id}/volumes/{volume_id}")
+async def get_volume(request: web.Request) -> web.Response:
+    try:
+        volume = volumes[request.match_info["volume_id"]]
+    except KeyError:
+        return web.Response(status=404)
+    return json_response({"volume": volume.info()})
+
+
+@routes.put("/volumes/{volume_id}")
+@routes.put("/{project_id}/volumes/{volume_id}")
+async def update_volume(request: web.Request) -> web.Response:
+    try:
+        volume = volumes[request.match_info["volume_id"]]
+    except KeyError:
+        return web.Response(status=404)
+    data = (await request.json()).get("volume", {})
+    for field in ("name", "description", "metadata"):
+        if field in data:
+            setattr(volume, field, data[field])
+    await volume.save()
+    return json_response({"volume": volume.info()})
+
+
+@routes.delete("/volumes/{volume_id}")
+@routes.delete("/{project_id}/volumes/{volume_id}")
+async def delete_volume(request: web.Request) -> web.Response:
+    volume_id = request.match_info["volume_id"]
+    try:
+        volume = volumes[volume_id]
+    except KeyError:
+        return web.Response(status=404)
+    if volume.status not in ("available", "error"):
+        return web.Response(status=409)
+    del volumes[volume_id]
+    await volume.delete()
+    return web.Response(status=202)
+
+
+@routes.get("/snapshots")
+@routes.get("/snapshots/detail")
+@routes.get("/{project_id}/snapshots")
+@routes.get("/{project_id}/snapshots/detail")
+async def list_snapshots(request: web.Request) -> web.Response:
+    return json_response({"snapshots": [s.info() for s in snapshots.values()]})
+
+
+@routes.post("/snapshots")
+@routes.post("/{project_id}/snapshots")
+async def create_snapshot(request: web.Request) -> web.Response:
+    try:
+        data = (await request.json())["snapshot"]
+        volume = volumes[data["volume_id"]]
+    except (KeyError, TypeError):
+        return web.Response(status=400)
+    if volume.status == "in-use" and not data.get("force"):
+        return web.Response(status=409)
+    if volume.status not in ("available", "in-use"):
+        return web.Response(status=409)
+
+    snapshot = Snapshot(
+        str(uuid4()),
+        volume.id,
+        volume.size,
+        name=data.get("name"),
+        description=data.get("description"),
+    )
+    snapshots[snapshot.id] = snapshot
+    await snapshot.save()
+    _background(snapshot, convert_image(volume.path, snapshot.path))
+    return json_response({"snapshot": snapshot.info()}, status=202)
+
+
+@routes.get("/snapshots/{snapshot_id}")
+@routes.get("/{project_id}/snapshots/{snapshot_id}")
+async def get_snapshot(request: web.Request) -> web.Response:
+    try:
+        snapshot = snapshots[request.match_info["snapshot_id"]]
+    except KeyError:
+        return web.Response(status=404)
+    return json_response({"snapshot": snapshot.info()})
+
+
+@routes.delete("/snapshots/{snapshot_id}")
+@routes.delete("/{project_id}/snapshots/{snapshot_id}")
+async def delete_snapshot(request: web.Request) -> web.Response:
+    snapshot_id = request.match_info["snapshot_id"]
+    try:
+        snapshot = snapshots[snapshot_id]
+    except KeyError:
+        return web.Response(status=404)
+    if snapshot.status == "creating":
+        return web.Response(status=409)
+    del snapshots[snapshot_id]
+    await snapshot.delete()
+    return web.Response(status=202)
 
 
+app.on_startup.append(_load)
 app.add_routes(routes)
@@ -0,0 +1,205 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Finding out why things are slow, while they are slow."""
+import asyncio
+import collections
+import logging
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Counter, Optional
+
+from aiohttp import web
+
+from .util import json_response
+
+ADMIN_ROLE = "admins"
+MAX_PROFILE_SECONDS = 60
+
+routes = web.RouteTableDef()
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_filename.rpartition('/')[2]}:{code.co_name}"
+
+
+def _stack(frame) -> list:
+    stack = []
+    while frame:
+        stack.append(_frame_name(frame))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+def collect(thread_id: int, seconds: float, interval: float) -> Counter[str]:
+    """Sample the stacks of a thread, counting them collapsed."""
+    stacks: Counter[str] = collections.Counter()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        if frame := sys._current_frames().get(thread_id):
+            stacks[";".join(_stack(frame))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+class Watchdog:
+    """Notice when the event loop gets blocked and tell by what.
+
+    A heartbeat callback runs on the loop, a thread checks it is on time
+    and logs the loop stack and request being served when it isn't.
+    """
+
+    def __init__(self, threshold: float = 0.25):
+        self.threshold = threshold
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread_id = 0
+        self._beat = time.monotonic()
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._thread_id = threading.get_ident()
+        loop.call_soon(self._heartbeat)
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def _heartbeat(self) -> None:
+        self._beat = time.monotonic()
+        self._loop.call_later(self.threshold / 2, self._heartbeat)
+
+    def _watch(self) -> None:
+        reported = None
+        while not self._loop.is_closed():
+            time.sleep(self.threshold / 2)
+            beat = self._beat
+            if beat == reported or time.monotonic() - beat < self.threshold:
+                continue
+            reported = beat
+            frame = sys._current_frames().get(self._thread_id)
+            route = None
+            stack = []
+            while frame:
+                request = frame.f_locals.get("request")
+                if route is None and isinstance(request, web.BaseRequest):
+                    route = f"{request.method} {request.path}"
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            logging.warning(
+                "event loop blocked for over %.3fs serving %s in %s",
+                self.threshold,
+                route or "nothing",
+                " <- ".join(stack[:8]),
+            )
+
+
+class SlowRequests:
+    """The most recent requests which took longer than threshold."""
+
+    def __init__(self, threshold: float = 1.0, keep: int = 50):
+        self.threshold = threshold
+        self.requests: collections.deque = collections.deque(maxlen=keep)
+
+    def configure(self, config: dict) -> None:
+        self.threshold = config.get("slow_request", self.threshold)
+        keep = config.get("keep", self.requests.maxlen)
+        if keep != self.requests.maxlen:
+            self.requests = collections.deque(self.requests, maxlen=keep)
+        watchdog.threshold = config.get("slow_callback", watchdog.threshold)
+
+    @web.middleware
+    async def middleware(
+        self, request: web.Request, handler: Callable
+    ) -> web.StreamResponse:
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            if duration > self.threshold:
+                auth, acl = request.get("timings", (0.0, 0.0))
+                resource = request.match_info.route.resource
+                self.requests.append(
+                    {
+                        "at": datetime.now(timezone.utc).isoformat("T", "seconds"),
+                        "method": request.method,
+                        "path": request.path,
+                        "route": resource.canonical if resource else None,
+                        "status": status,
+                        "duration": duration,
+                        "phases": {
+                            "auth": auth,
+                            "acl": acl,
+                            "handler": duration - auth - acl,
+                        },
+                    }
+                )
+
+
+watchdog = Watchdog()
+slow_requests = SlowRequests()
+_profiling = asyncio.Lock()
+
+
+def _is_admin(request: web.Request) -> bool:
+    user = request.get("user")
+    return user is not None and ADMIN_ROLE in request["app_config"].acl.roles(user)
+
+
+@routes.get("/admin/profile")
+async def profile(request: web.Request) -> web.Response:
+    """Sample the event loop for a while, return collapsed stacks.
+
+    The output is what flamegraph.pl or speedscope expect.
+    """
+    if not _is_admin(request):
+        return web.Response(status=403)
+    try:
+        seconds = min(float(request.query.get("seconds", 5)), MAX_PROFILE_SECONDS)
+        interval = float(request.query.get("interval", 5)) / 1000
+    except ValueError:
+        return web.Response(status=400)
+    if _profiling.locked():
+        return web.Response(status=409)
+    async with _profiling:
+        stacks = await asyncio.get_running_loop().run_in_executor(
+            None, collect, threading.get_ident(), seconds, max(interval, 0.001)
+        )
+    return web.Response(
+        text="".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+    )
+
+
+@routes.get("/admin/slow")
+async def slow(request: web.Request) -> web.Response:
+    if not _is_admin(request):
+        return web.Response(status=403)
+    return json_response(
+        {
+            "threshold": slow_requests.threshold,
+            "requests": sorted(
+                slow_requests.requests, key=lambda r: r["duration"], reverse=True
+            ),
+        }
+    )
+
+
+async def on_startup(app: web.Application) -> None:
+    watchdog.start(asyncio.get_running_loop())
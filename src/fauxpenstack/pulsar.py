@@ -13,22 +13,29 @@
 # limitations under the License.
 """pulsar n. magnetic rotating star formed by the collapse of a supernova"""
 
+import asyncio
+import collections
 import logging
+import math
 import os
 import random
-import subprocess
+import shutil
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Optional
+from typing import AsyncIterator, Callable, Dict, Optional, Tuple
 from uuid import uuid4
 
 import aiofiles
 from aiohttp import web
 
-from .metadata import mk_metadata
-from .peek import get_image_by_id
-from .plaster import make_volume_from_image
-from .util import make_endpoint
+from . import compute, configdrive, events, metrics, qmp
+from .compute import CONSOLES
+from .metadata import drive_files, instance_files, mk_metadata
+from .neutrino import AddressesExhausted, ipam
+from .peek import get_image_by_id, image_saved, reserve_image
+from .placement import CoresExhausted
+from .plaster import VOLUMES, convert_image, make_volume_from_image, volumes
+from .util import json_response, json_stream, make_endpoint
 
 routes = web.RouteTableDef()
 app = web.Application()
@@ -37,12 +44,20 @@ app["ep_name"] = __name__
 make_endpoint(routes, "2.1")
 
 KEYPAIRS = Path("keypairs")
-CONSOLES = Path("consoles")
 AZ_NAME = "nova"
 
 
 # No persistence. When fauxpenstack dies, so do the VMs.
 instances = {}
+# keep references to background jobs so they don't get collected
+_jobs = set()
+
+# lifecycle of instances: created, address, active, error, deleted
+bus = events.Bus()
+WATCH_INTERVAL = 1.0
+# longest wait on changes-since, in seconds
+LONG_POLL = 60.0
+_watcher: Optional[asyncio.Task] = None
 
 
 class Instance:
@@ -61,6 +76,7 @@ class Instance:
         bridge=None,
         tags=None,
         metadata=None,
+        port=None,
     ):
         self.id = id
         self.name = name
@@ -72,14 +88,25 @@ class Instance:
         self._image = image
         self._volume = volume or image
         self._flavor = flavor
-        self._br_hwadd = self.gen_hwadd()
+        self._port = port
+        self._br_hwadd = port.mac if port else self.gen_hwadd()
         self._br = bridge
+        self._qmp = CONSOLES / f"{id}.qmp"
+        self._meta = CONSOLES / f"{id}.meta"
+        self._drive = None
+        self._meta_shutdown: Callable[[], None] = lambda: None
+        self._driver = compute.driver(flavor)
+        self._attachments = {}  # volume id -> guest device
+        # as published, static addresses are there from the start
+        self._seen: Tuple[str, Optional[str]] = ("BUILD", port and str(port.ip))
         self.metadata = metadata or {}
 
     async def setup(self):
-        self._meta_shutdown, meta_port = await mk_metadata(self)
-        arch = self._image.name.split(".")[-2]
-        await self._spawn(arch, self._volume, meta_port, self._flavor)
+        if self._driver.guest:
+            files = await instance_files(self)
+            self._meta_shutdown = await mk_metadata(files, self._meta)
+            self._drive = await configdrive.acquire(drive_files(files))
+        await self._driver.spawn(self, self._image.name.split(".")[-2])
 
     @staticmethod
     def gen_hwadd() -> str:
@@ -95,31 +122,27 @@ class Instance:
 
     @property
     def accessIPv4(self):
-        """bridged arp lookup"""
-        if not self._br_hwadd:
-            return None
-        with open("/proc/net/arp") as f:
-            while entry := f.readline():
-                if self._br_hwadd in entry:
-                    return entry.partition(" ")[0]
-        return None
+        """static address, or whatever the driver found"""
+        return self._address()
+
+    def _address(self, arp: Optional[Dict[str, str]] = None) -> Optional[str]:
+        if self._port:
+            return str(self._port.ip)
+        return self._driver.address(arp)
 
     def __del__(self):
         try:
-            os.remove(CONSOLES / self.id)
+            os.remove(self._meta)
         except OSError:
             pass
 
-        if self._sub:
-            try:
-                self._sub.kill()
-                # reap zombies
-                self._sub.communicate()
-                self._sub = None
-            except Exception:
-                pass
+        self._driver.stop()
         self._volume_cleanup()
+        if self._port:
+            ipam.release(self._port)
         self._meta_shutdown()
+        if self._drive:
+            configdrive.release(self._drive)
 
     def _volume_cleanup(self):
         # Only cleanup if the volume is not an image
@@ -128,93 +151,192 @@ class Instance:
             logging.debug("dropping instance volumes")
             self._volume.unlink()
 
-    async def _spawn(self, arch, volume_file, metadata_port, flavor, bridge=None):
-        nic_model = "virtio-net-pci"
-        if arch == "s390x":
-            nic_model = "virtio"
-
-        args = [
-            f"qemu-system-{arch}",
-            "-nographic",
-            "-uuid",
-            self.id,
-            "-serial",
-            f"file:{CONSOLES / self.id}",
-            "-drive",
-            f"file={volume_file},if=virtio",
-            "-m",
-            f"{flavor['ram']}M",
-            # metadata-only network
-            "-nic",
-            f"user,hostname={self.hostname},model={nic_model},net=169.254.169.0/24,restrict=on,"
-            f"guestfwd=tcp:169.254.169.254:80-cmd:nc 127.0.0.1 {metadata_port}",
-        ]
-
-        match arch:
-            case "x86_64":
-                args.append("-enable-kvm")
-                args.extend(
-                    # pants on fire
-                    ["-smbios", "type=1,product=OpenStack Compute"]
-                )
-            case "aarch64":
-                # impdef is "less secure" but way faster
-                args.extend(["-machine", "virt", "-cpu", "max,pauth-impdef=on"])
-                args.extend(["-bios", "/usr/share/qemu-efi-aarch64/QEMU_EFI.fd"])
-
-        if (ncpus := flavor["vcpus"]) > 1:
-            args.append("-smp")
-            args.append(str(ncpus))
-
-        if self._br:
-            args.append("-nic")
-            args.append(f"bridge,model={nic_model},br={self._br},mac={self._br_hwadd}")
-        logging.debug("spawning %r", args)
-
-        # del and async don't play together.
-        self._sub = subprocess.Popen(
-            args, stdin=open("/dev/null"), stdout=open("/dev/null", "w")
+    async def pause(self):
+        """Stop the guest for a snapshot, QMPError if it can't be."""
+        await qmp.execute(self._qmp, "stop")
+
+    async def snapshot(self, dest: Path):
+        """Flatten the disk of a paused instance into dest.
+
+        The guest is resumed as soon as its overlay is copied, the slow
+        flattening happens on the copy.
+        """
+        tmp = VOLUMES / f"{uuid4()}.snap"
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, shutil.copyfile, self._volume, tmp
+            )
+        finally:
+            try:
+                await qmp.execute(self._qmp, "cont")
+            except qmp.QMPError as e:
+                logging.error("could not resume %s after snapshot: %s", self.id, e)
+        try:
+            await convert_image(tmp, dest)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    async def attach(self, volume) -> str:
+        """Hot plug a volume into the running guest."""
+        node = _node_name(volume.id)
+        tuning = self._driver.tuning
+        options = tuning.blockdev_options()
+        aio = {"aio": options.pop("aio")} if "aio" in options else {}
+        await qmp.execute(
+            self._qmp,
+            "blockdev-add",
+            **{
+                "node-name": node,
+                "driver": "qcow2",
+                "file": {
+                    "driver": "file",
+                    "filename": str(volume.path.absolute()),
+                    **aio,
+                },
+                **options,
+            },
+        )
+        arch = self._image.name.split(".")[-2]
+        device = {"driver": compute.blk_device(arch), "id": node, "drive": node}
+        if tuning.iothreads:
+            device["iothread"] = f"io{len(self._attachments) % tuning.iothreads}"
+        await qmp.execute(self._qmp, "device_add", **device)
+        used = set(self._attachments.values())
+        # vda is the root disk, and the config drive comes right after
+        first = "c" if self._drive else "b"
+        device = next(
+            d
+            for d in (f"/dev/vd{c}" for c in "bcdefghijklmnopqrstuvwxyz")
+            if d >= f"/dev/vd{first}" and d not in used
         )
+        self._attachments[volume.id] = device
+        return device
+
+    async def detach(self, volume) -> None:
+        node = _node_name(volume.id)
+        self._attachments.pop(volume.id, None)
+        await qmp.execute(self._qmp, "device_del", id=node)
+        # unplug needs the guest to cooperate, give it some time
+        for _ in range(20):
+            try:
+                await qmp.execute(self._qmp, "blockdev-del", **{"node-name": node})
+                return
+            except qmp.QMPError:
+                await asyncio.sleep(0.5)
+        logging.warning("%s did not release volume %s", self.id, volume.id)
+
+    def attachment_info(self, volume_id: str) -> dict:
+        return {
+            "id": volume_id,
+            "volumeId": volume_id,
+            "serverId": self.id,
+            "device": self._attachments[volume_id],
+        }
+
+    def state(self, arp: Optional[Dict[str, str]] = None) -> Tuple[str, Optional[str]]:
+        """status and address, arp as in Driver.address"""
+        status = self._driver.status()
+        ipv4 = self._address(arp)
+        if status == "ACTIVE" and not ipv4:
+            # Not quite true, but network info is assumed to be available
+            # on active instances, and we rely on dhcp because we're too lazy
+            # to really manage network... So it'll look like a fast boot ;)
+            status = "BUILD"
+        return status, ipv4
 
     def info(self):
         data = {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
-        ipv4 = self.accessIPv4
+        data["status"], ipv4 = self.state()
         if ipv4:
             data["accessIPv4"] = ipv4
             data["addresses"] = {"private": [{"addr": ipv4}]}
-            data["status"] = "ACTIVE"
-        else:
-            # Not quite true, but network info is assumed to be available
-            # on active instances, and we rely on dhcp because we're too lazy
-            # to really manage network... So it'll look like a fast boot ;)
-            data["status"] = "BUILD"
-
-        if self._sub and self._sub.returncode is not None:
-            data["status"] = "ERROR"
         return data
 
+    def publish(self, kind: str) -> None:
+        status, ipv4 = self._seen
+        bus.publish(kind, server_id=self.id, status=status, accessIPv4=ipv4)
+
+
+def _publish_changes(arp: Dict[str, str]) -> None:
+    for instance in [*instances.values()]:
+        seen, instance._seen = instance._seen, instance.state(arp)
+        status, ipv4 = instance._seen
+        if ipv4 != seen[1]:
+            instance.publish("address")
+        if status != seen[0]:
+            instance.publish(status.lower())
+
+
+async def _watch() -> None:
+    """Publish how instances change, while someone waits for it.
+
+    Changes in between get published once someone does. Nothing here
+    holds on to instances while sleeping, they get cleaned up as soon as
+    they are deleted.
+    """
+    loop = asyncio.get_running_loop()
+    while instances and bus.waiting:
+        try:
+            arp = await loop.run_in_executor(None, compute.arp_table)
+        except OSError:
+            arp = {}
+        _publish_changes(arp)
+        await asyncio.sleep(WATCH_INTERVAL)
+
+
+def _ensure_watcher() -> None:
+    global _watcher
+    if _watcher is None or _watcher.done():
+        _watcher = asyncio.create_task(_watch())
+
+
+bus.on_wait = _ensure_watcher
+
+
+def _count_instances():
+    # as drivers see them, active ones may still be waiting for an address
+    statuses = collections.Counter(i._driver.status() for i in instances.values())
+    return {(status,): count for status, count in statuses.items()}
+
+
+metrics.INSTANCES.function = _count_instances
+
+
+def _node_name(volume_id: str) -> str:
+    # qemu caps node names to 31 chars
+    return "vol" + volume_id.replace("-", "")[:24]
+
+
+async def _servers() -> AsyncIterator[dict]:
+    # instances may come and go while this gets sent
+    for server_id in [*instances]:
+        if instance := instances.get(server_id):
+            yield instance.info()
+
 
 @routes.get("/servers")
 @routes.get("/servers/detail")
-async def list_(request: web.Request) -> web.Response:
-    return web.json_response(
-        {"servers": [instance.info() for instance in instances.values()]}
-    )
+async def list_(request: web.Request) -> web.StreamResponse:
+    return await json_stream(request, _servers(), b'{"servers": [', b"]}")
 
 
 @routes.delete("/servers/{server_id}")
 async def delete(request: web.Request) -> web.Response:
     server_id = request.match_info["server_id"]
     try:
-        instances.pop(server_id)
+        instance = instances.pop(server_id)
     except KeyError:
         return web.Response(status=404)
+    for volume_id in instance._attachments:
+        if volume := volumes.get(volume_id):
+            await volume.detached()
+    instance.publish("deleted")
     return web.Response(status=204)
 
 
 @routes.post("/servers")
 async def create(request: web.Request) -> web.Response:
-    config = request.config_dict["app_config"]
+    config = request["app_config"]
     uuid = str(uuid4())
     data = await request.json()
     try:
@@ -227,11 +349,23 @@ async def create(request: web.Request) -> web.Response:
     if not image:
         return web.Response(status=404)
     try:
-        bridge = config["net_bridges"][data["networks"][0]["uuid"]]
+        network = data["networks"][0]["uuid"]
+        bridge = config["net_bridges"][network]
     except KeyError:
-        bridge = None
-    volume = await make_volume_from_image(uuid, image, flavor["disk"])
+        network = bridge = None
+    if "name" not in data:
+        return web.Response(status=400)
+    volume = None
+    if compute.driver_class(flavor).guest:
+        volume = await make_volume_from_image(uuid, image, flavor["disk"])
+    try:
+        port = network and ipam.allocate(network, Instance.gen_hwadd(), uuid)
+    except AddressesExhausted:
+        if volume:
+            volume.unlink()
+        return web.Response(status=409)
 
+    # from here on, dropping the instance gives back the volume and port
     instance = instances[uuid] = Instance(
         uuid,
         data["name"],
@@ -244,15 +378,59 @@ async def create(request: web.Request) -> web.Response:
         bridge,
         tags=data.get("tags"),
         metadata=data.get("metadata"),
+        port=port,
     )
-    await instance.setup()
-    return web.json_response(
+    try:
+        await instance.setup()
+    except CoresExhausted:
+        del instances[uuid]
+        return web.Response(status=409)
+    except BaseException:
+        del instances[uuid]
+        raise
+    instance.publish("created")
+    return json_response(
         {"server": {"id": uuid, "links": []}},
         headers={"Location": f"{request.url}/{uuid}"},
         status=202,
     )
 
 
+def _since(request: web.Request, default: int) -> int:
+    since = request.query.get("since") or request.headers.get("Last-Event-ID")
+    return int(since) if since else default
+
+
+@routes.get("/servers/events")
+async def server_events(request: web.Request) -> web.StreamResponse:
+    """Changes as Server-Sent Events, from now or since Last-Event-ID"""
+    try:
+        since = _since(request, bus.seq)
+    except ValueError:
+        return web.Response(status=400)
+    return await events.stream(request, bus, since)
+
+
+@routes.get("/servers/changes-since")
+async def changes_since(request: web.Request) -> web.Response:
+    """Changes after since, waiting up to timeout seconds for some.
+
+    410 when they are no longer all around, time to list servers again.
+    """
+    try:
+        since = _since(request, 0)
+        timeout = float(request.query.get("timeout", 0))
+    except ValueError:
+        return web.Response(status=400)
+    if not math.isfinite(timeout) or timeout < 0:
+        return web.Response(status=400)
+    timeout = min(timeout, LONG_POLL)
+    changes = await bus.wait(since, timeout)
+    if changes is None:
+        return json_response({"last": bus.seq}, status=410)
+    return json_response({"events": changes, "last": bus.seq})
+
+
 @routes.get("/servers/{server_id}")
 async def get_server(request: web.Request) -> web.Response:
     server_id = request.match_info["server_id"]
@@ -261,28 +439,160 @@ async def get_server(request: web.Request) -> web.Response:
     except KeyError:
         return web.Response(status=404)
     data = {"server": {"id": server_id, **instance.info()}}
-    return web.json_response(data)
+    return json_response(data)
 
 
 @routes.post("/servers/{server_id}/action")
 async def server_action(request: web.Request) -> web.Response:
     server_id = request.match_info["server_id"]
-    for action in await request.json():
+    data = await request.json()
+    for action in data:
         if action == "os-getConsoleOutput":
-            async with aiofiles.open(CONSOLES / server_id) as f:
-                return web.json_response({"output": await f.read()})
+            try:
+                instance = instances[server_id]
+            except KeyError:
+                return web.Response(status=404)
+            return json_response({"output": await instance._driver.console()})
+        if action == "createImage":
+            return await create_image(request, server_id, data[action])
 
-    return web.json_response()
+    return json_response()
+
+
+async def create_image(request: web.Request, server_id: str, data) -> web.Response:
+    try:
+        instance = instances[server_id]
+    except KeyError:
+        return web.Response(status=404)
+    try:
+        name = data["name"]
+    except (KeyError, TypeError):
+        return web.Response(status=400)
+    arch = instance._image.name.split(".")[-2]
+    image_id, path = await reserve_image(name, arch)
+    # copying the disk of a running guest makes for a corrupt image
+    try:
+        await instance.pause()
+    except qmp.QMPError as e:
+        logging.warning("could not pause %s for snapshot: %s", server_id, e)
+        await image_saved(image_id, ok=False)
+        return web.Response(status=409)
+
+    async def _save():
+        try:
+            await instance.snapshot(path)
+        except Exception:
+            logging.exception("snapshot of %s failed", server_id)
+            await image_saved(image_id, ok=False)
+        else:
+            await image_saved(image_id)
+
+    job = asyncio.create_task(_save())
+    _jobs.add(job)
+    job.add_done_callback(_jobs.discard)
+    return json_response(
+        {"image_id": image_id},
+        headers={"Location": f"{request.url.origin()}/images/v2/images/{image_id}"},
+        status=202,
+    )
+
+
+@routes.get("/servers/{server_id}/os-volume_attachments")
+async def list_volume_attachments(request: web.Request) -> web.Response:
+    try:
+        instance = instances[request.match_info["server_id"]]
+    except KeyError:
+        return web.Response(status=404)
+    return json_response(
+        {
+            "volumeAttachments": [
+                instance.attachment_info(volume_id)
+                for volume_id in instance._attachments
+            ]
+        }
+    )
+
+
+@routes.post("/servers/{server_id}/os-volume_attachments")
+async def attach_volume(request: web.Request) -> web.Response:
+    try:
+        instance = instances[request.match_info["server_id"]]
+    except KeyError:
+        return web.Response(status=404)
+    try:
+        volume = volumes[(await request.json())["volumeAttachment"]["volumeId"]]
+    except (KeyError, TypeError):
+        return web.Response(status=400)
+    if volume.status != "available":
+        return web.Response(status=409)
+
+    volume.status = "attaching"
+    try:
+        device = await instance.attach(volume)
+    except qmp.QMPError as e:
+        logging.error("could not attach %s to %s: %s", volume.id, instance.id, e)
+        volume.status = "available"
+        return web.Response(status=409)
+    await volume.attached(instance.id, device)
+    return json_response({"volumeAttachment": instance.attachment_info(volume.id)})
+
+
+@routes.get("/servers/{server_id}/os-volume_attachments/{volume_id}")
+async def get_volume_attachment(request: web.Request) -> web.Response:
+    try:
+        instance = instances[request.match_info["server_id"]]
+        data = instance.attachment_info(request.match_info["volume_id"])
+    except KeyError:
+        return web.Response(status=404)
+    return json_response({"volumeAttachment": data})
+
+
+@routes.delete("/servers/{server_id}/os-volume_attachments/{volume_id}")
+async def detach_volume(request: web.Request) -> web.Response:
+    volume_id = request.match_info["volume_id"]
+    try:
+        instance = instances[request.match_info["server_id"]]
+        volume = volumes[volume_id]
+    except KeyError:
+        return web.Response(status=404)
+    if volume_id not in instance._attachments:
+        return web.Response(status=404)
+
+    volume.status = "detaching"
+    try:
+        await instance.detach(volume)
+    except qmp.QMPError as e:
+        logging.error("could not detach %s from %s: %s", volume_id, instance.id, e)
+    await volume.detached()
+    return web.Response(status=202)
 
 
 @routes.get("/servers/{server_id}/os-security-groups")
 async def get_server_secgroups(request: web.Request) -> web.Response:
-    return web.json_response({"security-groups": []})
+    return json_response({"security-groups": []})
 
 
 @routes.get("/servers/{server_id}/os-interface")
 async def get_server_ports(request: web.Request) -> web.Response:
-    return web.json_response({"interfaceAttachments": []})
+    try:
+        port = instances[request.match_info["server_id"]]._port
+    except KeyError:
+        return web.Response(status=404)
+    if not port:
+        return json_response({"interfaceAttachments": []})
+    return json_response(
+        {
+            "interfaceAttachments": [
+                {
+                    "port_id": port.id,
+                    "net_id": port.network_id,
+                    "mac_addr": port.mac,
+                    "fixed_ips": port.info()["fixed_ips"],
+                    "port_state": "ACTIVE",
+                }
+            ]
+        }
+    )
 
 
 @routes.post("/os-keypairs")
@@ -295,12 +605,12 @@ async def import_keypair(request: web.Request) -> web.Response:
             await f.write(data["public_key"])
     except KeyError:
         return web.Response(status=400)
-    return web.json_response({"keypair": {"name": name}})
+    return json_response({"keypair": {"name": name}})
 
 
 @routes.get("/os-keypairs")
 async def list_keypair(request: web.Request) -> web.Response:
-    return web.json_response(
+    return json_response(
         {
             "keypairs": [
                 {"keypair": {"name": name, "type": "ssh"}}
@@ -323,19 +633,31 @@ async def delete_keypair(request: web.Request) -> web.Response:
 @routes.get("/flavors")
 @routes.get("/flavors/detail")
 async def get_flavors_details(request: web.Request) -> web.Response:
-    return web.json_response(
-        {
-            "flavors": [
-                {"name": k, "id": k, **v}
-                for k, v in request.config_dict["app_config"]["flavors"].items()
-            ]
-        }
-    )
+    return json_response({"flavors": request["app_config"].flavors})
+
+
+@routes.get("/flavors/{flavor_id}/os-extra_specs")
+async def get_extra_specs(request: web.Request) -> web.Response:
+    try:
+        flavor = request["app_config"]["flavors"][request.match_info["flavor_id"]]
+    except KeyError:
+        return web.Response(status=404)
+    return json_response({"extra_specs": flavor.get("extra_specs", {})})
+
+
+@routes.get("/flavors/{flavor_id}/os-extra_specs/{key}")
+async def get_extra_spec(request: web.Request) -> web.Response:
+    key = request.match_info["key"]
+    try:
+        flavor = request["app_config"]["flavors"][request.match_info["flavor_id"]]
+        return json_response({key: flavor["extra_specs"][key]})
+    except KeyError:
+        return web.Response(status=404)
 
 
 @routes.get("/os-availability-zone")
 async def list_az(request: web.Request) -> web.Response:
-    return web.json_response(
+    return json_response(
         {
             "availabilityZoneInfo": [
                 {
@@ -348,4 +670,5 @@ async def list_az(request: web.Request) -> web.Response:
     )
 
 
+app.on_startup.append(configdrive.clear)
 app.add_routes(routes)
@@ -0,0 +1,52 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Just enough of a QMP client to poke at running qemu processes."""
+import asyncio
+import json
+from pathlib import Path
+from typing import Any
+
+
+class QMPError(Exception):
+    pass
+
+
+async def _read_reply(reader: asyncio.StreamReader) -> Any:
+    while line := await reader.readline():
+        msg = json.loads(line)
+        if "event" in msg:
+            continue
+        if "error" in msg:
+            raise QMPError(msg["error"].get("desc", msg["error"]))
+        return msg.get("return")
+    raise QMPError("connection closed")
+
+
+async def execute(sock: Path, command: str, **arguments) -> Any:
+    """Run a single QMP command on the monitor socket and return its result."""
+    try:
+        reader, writer = await asyncio.open_unix_connection(str(sock))
+    except OSError as e:
+        raise QMPError(str(e))
+    try:
+        await reader.readline()  # greeting
+        writer.write(b'{"execute": "qmp_capabilities"}\n')
+        await _read_reply(reader)
+        msg = {"execute": command}
+        if arguments:
+            msg["arguments"] = arguments
+        writer.write(json.dumps(msg).encode("utf-8") + b"\n")
+        return await _read_reply(reader)
+    finally:
+        writer.close()
@@ -0,0 +1,253 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Record traffic to a jsonl file, and replay it against a server."""
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+import aiohttp
+from aiohttp import web
+
+from .util import dumps, encode
+
+# Tokens and such are deliberately left out, X-Auth-Token and
+# X-Subject-Token must never end up in a capture.
+HEADERS = ("Content-Type", "Accept", "User-Agent", "Range")
+# json bodies up to this size are kept, with strings under keys
+# looking like these blanked out
+BODY_LIMIT = 1 << 16
+SECRETS = ("pass", "secret", "token", "user_data", "private_key")
+REDACTED = "REDACTED"
+
+
+def _redact(value, secret: bool = False):
+    if isinstance(value, dict):
+        return {
+            k: _redact(v, secret or any(s in k.lower() for s in SECRETS))
+            for k, v in value.items()
+        }
+    if isinstance(value, list):
+        return [_redact(v, secret) for v in value]
+    return REDACTED if secret and isinstance(value, str) else value
+
+
+class Recorder:
+    """Append one line per request to a file.
+
+    Requests only pay for queueing a tuple, the json encoding and the
+    writes happen in batches on a background thread.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def _write(self) -> None:
+        with open(self.path, "a", buffering=1 << 16) as f:
+            entry = self._queue.get()
+            while entry is not None:
+                f.write(dumps(self._format(*entry)) + "\n")
+                try:
+                    entry = self._queue.get_nowait()
+                except queue.Empty:
+                    # caught up, flush this batch and wait for more
+                    f.flush()
+                    entry = self._queue.get()
+
+    @staticmethod
+    def _format(
+        ts, method, path, query, template, headers, size, body, status, duration
+    ):
+        entry = {
+            "ts": ts,
+            "method": method,
+            "path": path,
+            "query": query,
+            "template": template,
+            "headers": {k: v for k, v in zip(HEADERS, headers) if v is not None},
+            "body_size": size,
+            "status": status,
+            "duration": duration,
+        }
+        if body is not None:
+            try:
+                entry["body"] = _redact(json.loads(body))
+            except ValueError:
+                pass
+        return entry
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    async def cleanup(self, app: web.Application) -> None:
+        self.close()
+
+    @web.middleware
+    async def middleware(
+        self, request: web.Request, handler: Callable
+    ) -> web.StreamResponse:
+        ts = time.time()
+        start = time.monotonic()
+        status = 500
+        body = None
+        try:
+            if (
+                request.content_type == "application/json"
+                and 0 < (request.content_length or 0) <= BODY_LIMIT
+            ):
+                # kept around by aiohttp, handlers read it all the same
+                body = await request.read()
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            resource = request.match_info.route.resource
+            self._queue.put(
+                (
+                    ts,
+                    request.method,
+                    request.path,
+                    request.query_string,
+                    resource.canonical if resource else None,
+                    tuple(request.headers.get(h) for h in HEADERS),
+                    request.content_length or 0,
+                    body,
+                    status,
+                    time.monotonic() - start,
+                )
+            )
+
+
+def _percentile(values: list, pct: float) -> Optional[float]:
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def replay(
+    path: Path,
+    target: str,
+    speed: float = 1.0,
+    concurrency: int = 16,
+    token: Optional[str] = None,
+) -> dict:
+    """Replay a recording against target, returning throughput and latencies.
+
+    With a speed of 0 requests are sent as fast as concurrency allows,
+    otherwise the original pacing is kept, sped up by that factor.
+    json requests without a recorded body are skipped, other bodies are
+    made up of NUL bytes.
+    """
+    pending: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+    latencies = []
+    statuses: dict = {}
+    requests = errors = skipped = 0
+
+    async def _send(session: aiohttp.ClientSession, entry: dict):
+        nonlocal errors
+        headers = dict(entry.get("headers", {}))
+        if token:
+            headers["X-Auth-Token"] = token
+            # token validations check the replay token itself
+            if entry["method"] in ("GET", "HEAD") and entry["path"].endswith(
+                "/auth/tokens"
+            ):
+                headers["X-Subject-Token"] = token
+        url = target.rstrip("/") + entry["path"]
+        if entry.get("query"):
+            url += "?" + entry["query"]
+        body = None
+        if "body" in entry:
+            body = encode(entry["body"])
+        elif entry.get("body_size"):
+            body = b"\0" * entry["body_size"]
+            headers["Content-Type"] = "application/octet-stream"
+        sent = time.monotonic()
+        try:
+            async with session.request(
+                entry["method"], url, headers=headers, data=body
+            ) as response:
+                await response.read()
+                status = str(response.status)
+                statuses[status] = statuses.get(status, 0) + 1
+        except aiohttp.ClientError as e:
+            logging.debug("replay of %s failed: %s", entry["path"], e)
+            errors += 1
+            return
+        latencies.append(time.monotonic() - sent)
+
+    async def _worker(session: aiohttp.ClientSession):
+        while (entry := await pending.get()) is not None:
+            await _send(session, entry)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        workers = [asyncio.create_task(_worker(session)) for _ in range(concurrency)]
+        start = time.monotonic()
+        first = None
+        try:
+            with open(path) as f:
+                for line in filter(str.strip, f):
+                    entry = json.loads(line)
+                    requests += 1
+                    content_type = entry.get("headers", {}).get("Content-Type", "")
+                    if (
+                        entry.get("body_size")
+                        and "body" not in entry
+                        and content_type.startswith("application/json")
+                    ):
+                        skipped += 1
+                        continue
+                    if first is None:
+                        first = entry["ts"]
+                    if speed:
+                        due = start + (entry["ts"] - first) / speed
+                        await asyncio.sleep(max(0, due - time.monotonic()))
+                    await pending.put(entry)
+            for _ in workers:
+                await pending.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        elapsed = time.monotonic() - start
+
+    if not requests:
+        return {"requests": 0}
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "skipped": skipped,
+        "statuses": statuses,
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else None,
+        "latency": {
+            "p50": _percentile(latencies, 50),
+            "p90": _percentile(latencies, 90),
+            "p99": _percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+        },
+    }
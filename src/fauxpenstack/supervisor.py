@@ -0,0 +1,127 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Spreading requests over worker processes.
+
+Workers serve whatever only needs the disk, and hand the rest over to the
+supervisor process, which owns the VMs, volumes and addresses.
+"""
+import asyncio
+import logging
+import os
+import signal
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+from . import metrics
+
+SOCKET = Path("supervisor.sock")
+CHUNK_SIZE = 1 << 16
+CONNECT_TIMEOUT = 10
+HOP_BY_HOP = {
+    "connection",
+    "keep-alive",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+
+class Proxy:
+    """Forward requests to the supervisor, over its unix socket."""
+
+    def __init__(self, path: Path = SOCKET):
+        self.path = path
+        self._session = None
+
+    async def start(self, app: web.Application) -> None:
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.UnixConnector(path=str(self.path)),
+            auto_decompress=False,
+            # event streams and long polls take as long as they take
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT),
+        )
+
+    async def close(self, app: web.Application) -> None:
+        await self._session.close()
+
+    async def handler(self, request: web.Request) -> web.StreamResponse:
+        headers = [
+            (k, v) for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP
+        ]
+        try:
+            upstream = await self._session.request(
+                request.method,
+                f"http://supervisor{request.rel_url}",
+                headers=headers,
+                data=request.content if request.body_exists else None,
+                allow_redirects=False,
+            )
+        except aiohttp.ClientError as e:
+            logging.error("supervisor unreachable: %s", e)
+            return web.Response(status=502)
+        async with upstream:
+            response = web.StreamResponse(status=upstream.status)
+            response.headers.extend(
+                (k, v)
+                for k, v in upstream.headers.items()
+                if k.lower() not in HOP_BY_HOP
+            )
+            await response.prepare(request)
+            async for chunk in upstream.content.iter_chunked(CHUNK_SIZE):
+                await response.write(chunk)
+            await response.write_eof()
+        return response
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        """Our metrics, along with the supervisor's VMs, volumes and qemu."""
+        token = request.headers.get("X-Auth-Token")
+        headers = {"X-Auth-Token": token} if token else {}
+        remote = ""
+        try:
+            async with self._session.get(
+                "http://supervisor/metrics", headers=headers
+            ) as upstream:
+                if upstream.status == 200:
+                    remote = await upstream.text()
+        except aiohttp.ClientError as e:
+            logging.error("supervisor unreachable: %s", e)
+        return metrics.response(remote)
+
+    def app(self, sub: web.Application) -> web.Application:
+        """Stand in for sub, forwarding everything."""
+        app = web.Application()
+        app["ep_type"] = sub["ep_type"]
+        app["ep_name"] = sub["ep_name"]
+        # the catalog points at the first route
+        first = next(iter(sub.router.routes())).resource.canonical
+        app.router.add_route("*", first, self.handler)
+        app.router.add_route("*", "/{tail:.*}", self.handler)
+        return app
+
+
+async def watch_supervisor(app: web.Application) -> None:
+    """Stop a worker when its supervisor goes away."""
+    supervisor = os.getppid()
+
+    async def _watch():
+        while os.getppid() == supervisor:
+            await asyncio.sleep(1)
+        logging.error("Supervisor is gone. Shutting down.")
+        os.kill(os.getpid(), signal.SIGINT)
+
+    app["supervisor_watch"] = asyncio.create_task(_watch())
@@ -11,19 +11,96 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
+import functools
+import json
 import socket
+from typing import Any, AsyncIterable, Optional
 
 from aiohttp import web
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# listings get sent in chunks of about this size
+STREAM_CHUNK_SIZE = 1 << 16
+
+_public_address: Optional[str] = None
+
+if orjson:
+
+    def encode(data: Any) -> bytes:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+    def dumps(data: Any) -> str:
+        return encode(data).decode("utf-8")
+
+else:
+
+    def encode(data: Any) -> bytes:
+        return json.dumps(data).encode("utf-8")
+
+    dumps = json.dumps
+
+
+json_response = functools.partial(web.json_response, dumps=dumps)
+
+
+async def json_stream(
+    request: web.Request,
+    entries: AsyncIterable,
+    prefix: bytes = b"[",
+    suffix: bytes = b"]",
+) -> web.StreamResponse:
+    """Send entries as a json array while they get produced.
+
+    prefix and suffix wrap the array, to have it in an object.
+    """
+    response = web.StreamResponse()
+    response.content_type = "application/json"
+    await response.prepare(request)
+    chunk = bytearray(prefix)
+    separator = b""
+    async for entry in entries:
+        chunk += separator
+        chunk += encode(entry)
+        separator = b","
+        if len(chunk) >= STREAM_CHUNK_SIZE:
+            await response.write(chunk)
+            chunk = bytearray()
+            # let other requests through between chunks
+            await asyncio.sleep(0)
+    await response.write(chunk + suffix)
+    await response.write_eof()
+    return response
+
+
+async def public_address(request: web.Request) -> str:
+    """The address to advertise, from config or resolved once."""
+    global _public_address
+    if address := request["app_config"].get("public_address"):
+        return address
+    if _public_address is None:
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(
+                socket.gethostname(), None, family=socket.AF_INET
+            )
+        except OSError:
+            return request.url.host
+        _public_address = infos[0][4][0]
+    return _public_address
+
 
 def make_endpoint(routes, version, path=None):
     """Make an aggregate of generic version list and version."""
-    PUB_IP = socket.gethostbyname(socket.gethostname())
     path = path or ""
 
     @routes.get("/")
     async def versions(request: web.Request) -> web.Response:
         url = request.url
+        PUB_IP = await public_address(request)
 
         current = {
             "id": f"v{version}",
@@ -37,7 +114,7 @@ def make_endpoint(routes, version, path=None):
                 }
             ],
         }
-        return web.json_response(
+        return json_response(
             {
                 "versions": [current],
                 "version": current,
@@ -0,0 +1,161 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Images from iso9660.image, read back by hand and by bsdtar."""
+import shutil
+import struct
+import subprocess
+
+import pytest
+
+from fauxpenstack import iso9660
+
+SECTOR = iso9660.SECTOR
+
+FILES = {
+    "openstack/latest/meta_data.json": b'{"uuid": "1234"}',
+    "openstack/latest/user_data": b"#cloud-config\n" + b"x" * 5000,
+    "openstack/latest/vendor_data.json": b"{}",
+    "openstack/2012-08-10/meta_data.json": b'{"uuid": "1234"}',
+    "ec2/latest/meta-data.json": b"",
+}
+# enough of them for directories over several sectors
+MANY = {f"many/a-rather-long-file-name-{i:03}.txt": b"%d" % i for i in range(100)}
+
+
+def both32(data: bytes, offset: int) -> int:
+    little = struct.unpack_from("<I", data, offset)[0]
+    assert struct.unpack_from(">I", data, offset + 4)[0] == little
+    return little
+
+
+def descriptors(image: bytes) -> list:
+    found = []
+    for lba in range(iso9660.PRIMARY_LBA, len(image) // SECTOR):
+        sector = image[lba * SECTOR : (lba + 1) * SECTOR]
+        assert sector[1:6] == b"CD001"
+        found.append(sector)
+        if sector[0] == 255:
+            return found
+    pytest.fail("no terminator")
+
+
+def records(image: bytes, extent: int, size: int):
+    """(name, extent, size, is_dir) in a directory, without . and .."""
+    data = image[extent * SECTOR : extent * SECTOR + size]
+    offset = 0
+    while offset < len(data):
+        length = data[offset]
+        if not length:  # nothing more in this sector
+            offset += -offset % SECTOR or SECTOR
+            continue
+        record = data[offset : offset + length]
+        assert offset // SECTOR == (offset + length - 1) // SECTOR
+        name = record[33 : 33 + record[32]]
+        if name not in (b"\0", b"\1"):
+            yield name, both32(record, 2), both32(record, 10), bool(record[25] & 2)
+        offset += length
+
+
+def walk(image: bytes, descriptor: bytes, decode) -> dict:
+    """Files of a tree, by path."""
+    files = {}
+    pending = [("", both32(descriptor, 158), both32(descriptor, 166))]
+    while pending:
+        path, extent, size = pending.pop()
+        for name, extent, size, is_dir in records(image, extent, size):
+            child = f"{path}/{decode(name)}".lstrip("/")
+            if is_dir:
+                pending.append((child, extent, size))
+            else:
+                files[child] = image[extent * SECTOR : extent * SECTOR + size]
+    return files
+
+
+@pytest.mark.parametrize("files", [FILES, MANY])
+def test_joliet_tree(files):
+    image = iso9660.image("config-2", files)
+
+    assert len(image) % SECTOR == 0
+    primary, joliet, terminator = descriptors(image)
+    assert joliet[0] == 2
+    assert joliet[88:91] == iso9660.JOLIET_ESCAPE
+    assert joliet[40:72].decode("utf-16-be").rstrip() == "config-2"
+    assert both32(joliet, 80) == len(image) // SECTOR
+    assert walk(image, joliet, lambda name: name.decode("utf-16-be")) == files
+
+
+def test_primary_tree():
+    image = iso9660.image("config-2", FILES)
+
+    primary = descriptors(image)[0]
+    assert primary[0] == 1
+    assert primary[40:72].rstrip() == b"config-2"
+    assert both32(primary, 80) == len(image) // SECTOR
+    # contents are the same as in the Joliet tree
+    assert set(walk(image, primary, lambda name: name.decode("ascii"))) == {
+        "OPENSTACK/LATEST/META_DATA.JSON;1",
+        "OPENSTACK/LATEST/USER_DATA.;1",
+        "OPENSTACK/LATEST/VENDOR_DATA.JSON;1",
+        "OPENSTACK/2012_08_10/META_DATA.JSON;1",
+        "EC2/LATEST/META_DATA.JSON;1",
+    }
+
+
+def test_path_table():
+    image = iso9660.image("config-2", FILES)
+
+    primary = descriptors(image)[0]
+    size = both32(primary, 132)
+    table = image[struct.unpack_from("<I", primary, 140)[0] * SECTOR :][:size]
+    names = []
+    while table:
+        length = table[0]
+        names.append(table[8 : 8 + length])
+        table = table[8 + length + length % 2 :]
+    # root, then breadth first
+    assert names == [
+        b"\0",
+        b"EC2",
+        b"OPENSTACK",
+        b"LATEST",
+        b"2012_08_10",
+        b"LATEST",
+    ]
+
+
+def test_reproducible():
+    assert iso9660.image("config-2", FILES) == iso9660.image("config-2", FILES)
+
+
+@pytest.mark.skipif(not shutil.which("bsdtar"), reason="bsdtar is not installed")
+def test_bsdtar(tmp_path):
+    path = tmp_path / "drive.iso"
+    iso9660.create(path, "config-2", FILES)
+
+    listing = subprocess.run(
+        ["bsdtar", "-tf", str(path)], capture_output=True, text=True, check=True
+    )
+    assert set(FILES) <= {line.rstrip("/") for line in listing.stdout.splitlines()}
+    for name, data in FILES.items():
+        extracted = subprocess.run(
+            ["bsdtar", "-xOf", str(path), name], capture_output=True, check=True
+        )
+        assert extracted.stdout == data
+
+
+def test_create_refuses_existing(tmp_path):
+    path = tmp_path / "drive.iso"
+    path.touch()
+    with pytest.raises(FileExistsError):
+        iso9660.create(path, "config-2", FILES)
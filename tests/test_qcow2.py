@@ -0,0 +1,103 @@
+# Copyright 2023  Simon Poirier
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Images from qcow2.create, as seen by qemu-img."""
+import json
+import shutil
+import subprocess
+
+import pytest
+
+from fauxpenstack import qcow2
+
+needs_qemu_img = pytest.mark.skipif(
+    not shutil.which("qemu-img"), reason="qemu-img is not installed"
+)
+
+
+def qemu_img(*args) -> subprocess.CompletedProcess:
+    return subprocess.run(["qemu-img", *args], capture_output=True, text=True)
+
+
+def info(path) -> dict:
+    result = qemu_img("info", "--output=json", str(path))
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout)
+
+
+@needs_qemu_img
+@pytest.mark.parametrize(
+    "size",
+    [
+        1 << 20,
+        (10 << 20) + 512,  # not a whole cluster
+        64 << 30,
+        8 << 40,  # L1 table over several clusters
+    ],
+)
+def test_create(tmp_path, size):
+    path = tmp_path / "disk.qcow2"
+    qcow2.create(path, size)
+
+    check = qemu_img("check", str(path))
+    assert check.returncode == 0, check.stdout + check.stderr
+    image = info(path)
+    assert image["format"] == "qcow2"
+    assert image["virtual-size"] == size
+    assert image["cluster-size"] == qcow2.CLUSTER_SIZE
+    assert "backing-filename" not in image
+
+
+@needs_qemu_img
+def test_create_unaligned(tmp_path):
+    path = tmp_path / "disk.qcow2"
+    qcow2.create(path, (10 << 20) + 1)
+
+    check = qemu_img("check", str(path))
+    assert check.returncode == 0, check.stdout + check.stderr
+    assert info(path)["virtual-size"] == (10 << 20) + 512
+
+
+@pytest.mark.parametrize(
+    "size, rounded",
+    [(1, 512), (512, 512), (513, 1024), ((1 << 20) - 1, 1 << 20)],
+)
+def test_create_rounds_to_sectors(tmp_path, size, rounded):
+    path = tmp_path / "disk.qcow2"
+    qcow2.create(path, size)
+
+    header = qcow2.HEADER.unpack_from(path.read_bytes())
+    assert header[0] == qcow2.MAGIC
+    assert header[5] == rounded
+
+
+@needs_qemu_img
+def test_create_with_backing(tmp_path):
+    base = tmp_path / "base.qcow2"
+    overlay = tmp_path / "overlay.qcow2"
+    qcow2.create(base, 1 << 30)
+    qcow2.create(overlay, 2 << 30, base, "qcow2")
+
+    check = qemu_img("check", str(overlay))
+    assert check.returncode == 0, check.stdout + check.stderr
+    image = info(overlay)
+    assert image["virtual-size"] == 2 << 30
+    assert image["backing-filename"] == str(base)
+    assert image["backing-filename-format"] == "qcow2"
+
+
+def test_create_refuses_existing(tmp_path):
+    path = tmp_path / "disk.qcow2"
+    path.touch()
+    with pytest.raises(FileExistsError):
+        qcow2.create(path, 1 << 20)